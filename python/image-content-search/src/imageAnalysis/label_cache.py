@@ -0,0 +1,97 @@
+import json
+import logging
+import random
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger()
+
+# this module
+# caches Amazon Rekognition results by image content hash
+# in memory (LRU) in front of a DynamoDB table
+# requests left unprocessed by DynamoDB are retried with backoff; what is
+# still unprocessed after that is treated as a miss / not cached
+
+# attempts for a batch request whose items DynamoDB leaves unprocessed
+MAX_BATCH_ATTEMPTS = 8
+
+class LabelCache:
+
+    def __init__(self, dynamodb_client, table_name, max_size=1024):
+        self.dynamodb_client = dynamodb_client
+        self.table_name = table_name
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get_many(self, cache_keys):
+        """
+        Looks up cache keys in memory first and then in DynamoDB.
+        Returns a dict of cache key => cached analysis for the keys found.
+        """
+        found = {}
+        missing = []
+
+        for cache_key in set(cache_keys):
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+                found[cache_key] = self.entries[cache_key]
+            else:
+                missing.append(cache_key)
+
+        if self.table_name:
+            # BatchGetItem accepts up to 100 keys per call
+            for i in range(0, len(missing), 100):
+                request = {self.table_name: {
+                    'Keys': [{'cache_key': {'S': k}} for k in missing[i:i + 100]]
+                }}
+                for attempt in range(MAX_BATCH_ATTEMPTS):
+                    response = self.dynamodb_client.batch_get_item(RequestItems=request)
+                    for item in response['Responses'].get(self.table_name, []):
+                        analysis = json.loads(item['analysis']['S'])
+                        found[item['cache_key']['S']] = analysis
+                        self._remember(item['cache_key']['S'], analysis)
+                    request = response.get('UnprocessedKeys')
+                    if not request: break
+                    _backoff(attempt)
+                else:
+                    logger.warning('Label cache lookup incomplete, treating {} keys as misses'.format(
+                        len(request[self.table_name]['Keys'])))
+
+        return found
+
+    def put_many(self, analyses):
+        """
+        Stores a dict of cache key => analysis in memory and in DynamoDB.
+        """
+        for cache_key, analysis in analyses.items():
+            self._remember(cache_key, analysis)
+
+        if not self.table_name: return
+
+        items = list(analyses.items())
+        # BatchWriteItem accepts up to 25 items per call
+        for i in range(0, len(items), 25):
+            request = {self.table_name: [{'PutRequest': {'Item': {
+                'cache_key': {'S': cache_key},
+                'analysis': {'S': json.dumps(analysis)}
+            }}} for cache_key, analysis in items[i:i + 25]]}
+            for attempt in range(MAX_BATCH_ATTEMPTS):
+                response = self.dynamodb_client.batch_write_item(RequestItems=request)
+                request = response.get('UnprocessedItems')
+                if not request: break
+                _backoff(attempt)
+            else:
+                logger.warning('Label cache write incomplete, {} analyses not cached'.format(
+                    len(request[self.table_name])))
+
+    def _remember(self, cache_key, analysis):
+        if self.max_size <= 0: return
+
+        self.entries[cache_key] = analysis
+        self.entries.move_to_end(cache_key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+def _backoff(attempt):
+    # exponential backoff with full jitter, capped at one second
+    time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
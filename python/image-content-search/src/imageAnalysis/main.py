@@ -3,6 +3,14 @@ import botocore.config
 import os
 import logging
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+from label_cache import LabelCache  # type: ignore
+
+max_workers = int(os.getenv('MAX_WORKERS') or '10')
+max_labels = int(os.getenv('MAX_LABELS') or '20')
+min_confidence = float(os.getenv('MIN_CONFIDENCE') or '85')
+include_label_parents = (os.getenv('INCLUDE_LABEL_PARENTS') or 'false').lower() == 'true'
 
 aws_config = botocore.config.Config(
     region_name = os.getenv('REGION'),
@@ -10,7 +18,8 @@ aws_config = botocore.config.Config(
     retries = {
         'max_attempts': int(os.getenv('DEFAULT_MAX_CALL_ATTEMPTS') or '1'),
         'mode': 'standard'
-    }
+    },
+    max_pool_connections = max_workers
 )
 
 logger = logging.getLogger()
@@ -19,60 +28,181 @@ logger.setLevel(logging.INFO)
 events_client = boto3.client('events', config=aws_config)
 rekognition_client = boto3.client('rekognition', config=aws_config)
 
+# Rekognition results keyed by image content hash and model parameters
+label_cache = LabelCache(boto3.client('dynamodb', config=aws_config),
+    os.getenv('ICS_LABEL_CACHE_TABLE'),
+    max_size=int(os.getenv('LABEL_CACHE_SIZE') or '1024'))
+
 event_bus_name = os.getenv('EVENT_BUS')
 
+# PutEvents accepts at most 256 KB per request, leave room for the envelope
+max_event_bytes = 240 * 1024
+
 # this function
-# gets the SQS message
-# calls Amazon Rekognition to analyze the image
-# publish an event in Amazon EventBridge
+# gets a batch of SQS messages
+# looks up earlier results for the same image content in the label cache
+# calls Amazon Rekognition to analyze the other images, concurrently
+# publishes the labels of the whole batch as one event in Amazon EventBridge
+# reports the messages that failed so only those are retried
 
 def handler(event, context):
+    bucket = os.environ['ICS_IMAGES_BUCKET']
+    records = event['Records']
 
-    for record in event['Records']:
-        # receiptHandle = record['receiptHandle']
-        body = record['body']
-        message = json.loads(body)
-
-        bucket = os.environ['ICS_IMAGES_BUCKET']
-        key = message['image']
-        # original_key = message['original_key']
-        # original_last_modified = message['original_last_modified']
-        # etag = message['etag']
-
-        logger.info('Processing {}.'.format(key))
+    failed_message_ids = []
+    messages = []
 
-        detected_labels = rekognition_client.detect_labels(
-            Image={'S3Object': {'Bucket': bucket, 'Name': key}},
-            MaxLabels=20,
-            MinConfidence=85)
-
-        detected_unsafe_contents = rekognition_client.detect_moderation_labels(
-            Image={'S3Object': {'Bucket': bucket, 'Name': key}})
-
-        object_labels = []
-
-        for l in detected_labels['Labels']:
-            object_labels.append(l['Name'].lower()) # add objects in image
-
-        for l in detected_unsafe_contents['ModerationLabels']:
-            if ('offensive' not in object_labels): object_labels.append("offensive") #label image as offensive
-            object_labels.append(l['Name'].lower())
+    for record in records:
+        try:
+            key = json.loads(record['body'])['image']
+        except (ValueError, KeyError) as e:
+            logger.error('Invalid message {}: {}'.format(record['messageId'], e))
+            failed_message_ids.append(record['messageId'])
+            continue
 
+        # processed images are stored by their SHA1, so the key addresses the content
         image_id = key.split("/")[-1]
+        cache_key = '{}#{}#{}'.format(image_id, max_labels, min_confidence)
+        messages.append((record, key, image_id, cache_key))
+
+    try:
+        cached = label_cache.get_many([cache_key for _, _, _, cache_key in messages])
+    except Exception as e:
+        logger.warning('Label cache lookup failed: {}'.format(e))
+        cached = {}
+
+    # issue both Rekognition calls for every uncached record at once
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, 2 * len(records)))) as executor:
+        analyses = []
+        for record, key, image_id, cache_key in messages:
+            if cache_key in cached:
+                logger.info('Found {} in the label cache.'.format(key))
+                analyses.append((record, key, image_id, cache_key, None, None))
+                continue
+
+            logger.info('Processing {}.'.format(key))
+            image = {'S3Object': {'Bucket': bucket, 'Name': key}}
+            analyses.append((record, key, image_id, cache_key,
+                executor.submit(rekognition_client.detect_labels, Image=image, MaxLabels=max_labels, MinConfidence=min_confidence),
+                executor.submit(rekognition_client.detect_moderation_labels, Image=image)))
+
+    images = []
+    new_analyses = {}
+
+    for record, key, image_id, cache_key, detected_labels, detected_unsafe_contents in analyses:
+        try:
+            analysis = cached.get(cache_key)
+            if analysis is None:
+                analysis = get_analysis(detected_labels.result(), detected_unsafe_contents.result())
+                new_analyses[cache_key] = analysis
+            labels = get_labels(analysis)
+        except Exception as e:
+            logger.error('Failed to analyze {}: {}'.format(key, e))
+            failed_message_ids.append(record['messageId'])
+            continue
+
+        images.append((record['messageId'], {
+            "labels": list(labels),
+            "label_confidences": labels,
+            "image_id": image_id
+        }))
+
+    failed_message_ids.extend(put_events(images, context.invoked_function_arn))
+
+    try:
+        label_cache.put_many(new_analyses)
+    except Exception as e:
+        logger.warning('Label cache update failed: {}'.format(e))
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+    }
+
+def get_analysis(detected_labels, detected_unsafe_contents):
+    # keep only the fields needed to build the labels, so cache entries stay small
+    return {
+        'Labels': [{
+            'Name': l['Name'],
+            'Confidence': l['Confidence'],
+            'Parents': [{'Name': p['Name']} for p in l.get('Parents', [])]
+        } for l in detected_labels['Labels']],
+        'ModerationLabels': [{
+            'Name': l['Name'],
+            'Confidence': l['Confidence'],
+            'ParentName': l.get('ParentName', '')
+        } for l in detected_unsafe_contents['ModerationLabels']]
+    }
 
-        response = events_client.put_events(
-            Entries=[
-                {
-                    'Source': "EventBridge",
-                    'Resources': [
-                        context.invoked_function_arn,
-                    ],
-                    'DetailType': 'images_labels',
-                    'Detail': json.dumps({"labels": object_labels, "image_id": image_id}),
-                    'EventBusName': event_bus_name
-                },
-            ]
-        )
-
-        if response["FailedEntryCount"] == 1:
-            raise Exception(f'Failed entry observed. Count: {response["Entries"]}')
+def get_labels(analysis):
+    """
+    Merges object and moderation labels into an ordered set of unique,
+    lowercase labels, mapped to the highest confidence seen for each.
+    With INCLUDE_LABEL_PARENTS, parent labels/categories are added too.
+    """
+    labels = {}
+
+    def add(name, confidence):
+        if not name: return
+        name = name.lower()
+        labels[name] = max(confidence, labels.get(name, 0))
+
+    for l in analysis['Labels']:
+        add(l['Name'], l['Confidence']) # add objects in image
+        if include_label_parents:
+            for p in l.get('Parents', []): add(p['Name'], l['Confidence'])
+
+    for l in analysis['ModerationLabels']:
+        add("offensive", l['Confidence']) #label image as offensive
+        add(l['Name'], l['Confidence'])
+        if include_label_parents: add(l.get('ParentName'), l['Confidence'])
+
+    return labels
+
+def put_events(images, function_arn):
+    """
+    Publishes (message id, image) pairs as "images" lists, one event per
+    batch unless the batch would exceed the PutEvents size limit.
+
+    :return: the message ids whose events could not be published
+    """
+    failed_message_ids = []
+
+    for chunk in chunk_images(images):
+        entry = {
+            'Source': "EventBridge",
+            'Resources': [
+                function_arn,
+            ],
+            'DetailType': 'images_labels',
+            'Detail': json.dumps({"images": [image for _, image in chunk]}),
+            'EventBusName': event_bus_name
+        }
+
+        try:
+            response = events_client.put_events(Entries=[entry])
+        except Exception as e:
+            logger.error('Failed to publish events: {}'.format(e))
+            failed_message_ids.extend(message_id for message_id, _ in chunk)
+            continue
+
+        if response['FailedEntryCount']:
+            logger.error('Failed entry observed: {}'.format(response['Entries'][0]))
+            failed_message_ids.extend(message_id for message_id, _ in chunk)
+
+    return failed_message_ids
+
+def chunk_images(images):
+    chunk = []
+    size = 0
+
+    for message_id, image in images:
+        image_size = len(json.dumps(image).encode('utf-8')) + 2
+        if chunk and size + image_size > max_event_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append((message_id, image))
+        size += image_size
+
+    if chunk:
+        yield chunk
@@ -1,18 +1,39 @@
 import boto3
 import botocore.config
+import botocore.exceptions
+import contextlib
+import json
 import logging
 import os
+import random
+import re
+import time
+
+try:
+    import pymysql  # type: ignore
+except ImportError:
+    pymysql = None
 
 cluster_arn = os.getenv('CLUSTER_ARN')
 credentials_arn = os.getenv('CREDENTIALS_ARN')
 db_name = os.getenv('DB_NAME')
 
+# when set (and the function can reach the cluster from its VPC), statements
+# go straight to MySQL over a connection reused across invocations instead
+# of through the Data API. pymysql must be packaged with the function.
+db_host = os.getenv('DB_HOST')
+db_port = int(os.getenv('DB_PORT') or '3306')
+
+max_call_attempts = int(os.getenv('DEFAULT_MAX_CALL_ATTEMPTS') or '1')
+
+# adaptive mode adds client-side rate limiting on top of jittered backoff
+# when the Data API throttles
 aws_config = botocore.config.Config(
     region_name = os.getenv('REGION'),
     signature_version = 'v4',
     retries = {
-        'max_attempts': int(os.getenv('DEFAULT_MAX_CALL_ATTEMPTS') or '1'),
-        'mode': 'standard'
+        'max_attempts': max_call_attempts,
+        'mode': 'adaptive'
     }
 )
 
@@ -21,22 +42,191 @@ logger.setLevel(logging.INFO)
 
 rds_client = boto3.client('rds-data', config=aws_config)
 
+# errors raised while an auto-paused Aurora Serverless cluster resumes
+RESUMING_ERRORS = ('DatabaseResumingException', 'Communications link failure')
+
+# MySQL client errors of a connection that went stale between invocations
+# ("server has gone away", "lost connection", "lost connection to server")
+STALE_CONNECTION_ERRORS = (2006, 2013, 2055)
+
+# the Data API transaction (or the flag for a driver transaction) that
+# statements currently run in
+current_transaction = None
+connection = None
+
 def execute_statement(sql, sql_parameters = []):
-    response = rds_client.execute_statement(
+    if db_host:
+        return driver_execute(sql, sql_parameters)
+
+    kwargs = {}
+    if current_transaction is not None:
+        kwargs['transactionId'] = current_transaction
+
+    return with_retries(lambda: rds_client.execute_statement(
         secretArn=credentials_arn,
         database=db_name,
         resourceArn=cluster_arn,
         sql=sql,
-        parameters=sql_parameters
-    )
-    return response
+        parameters=sql_parameters,
+        **kwargs
+    ), retry_resuming=current_transaction is None)
 
 def batch_execute_statement(sql, sql_parameter_sets):
-    response = rds_client.batch_execute_statement(
+    if db_host:
+        responses = [driver_execute(sql, p) for p in sql_parameter_sets]
+        return {'updateResults': [{} for _ in responses]}
+
+    kwargs = {}
+    if current_transaction is not None:
+        kwargs['transactionId'] = current_transaction
+
+    return with_retries(lambda: rds_client.batch_execute_statement(
         secretArn=credentials_arn,
         database=db_name,
         resourceArn=cluster_arn,
         sql=sql,
-        parameterSets=sql_parameter_sets
-    )
-    return response
+        parameterSets=sql_parameter_sets,
+        **kwargs
+    ), retry_resuming=current_transaction is None)
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Groups the statements executed in the block into one transaction, which
+    is committed at the end of the block or rolled back on error.
+    Nested blocks join the outer transaction.
+    """
+    global current_transaction
+
+    if current_transaction is not None:
+        yield
+        return
+
+    if db_host:
+        conn = get_connection()
+        try:
+            conn.begin()
+        except pymysql.err.OperationalError as e:
+            if e.args[0] not in STALE_CONNECTION_ERRORS:
+                raise
+            logger.warning(f'Database connection went stale, reconnecting: {e}')
+            reset_connection()
+            conn = get_connection()
+            conn.begin()
+        current_transaction = True
+        try:
+            yield
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            current_transaction = None
+        return
+
+    current_transaction = with_retries(lambda: rds_client.begin_transaction(
+        secretArn=credentials_arn,
+        database=db_name,
+        resourceArn=cluster_arn
+    ), retry_resuming=True)['transactionId']
+    try:
+        yield
+        rds_client.commit_transaction(secretArn=credentials_arn, resourceArn=cluster_arn,
+            transactionId=current_transaction)
+    except Exception:
+        rds_client.rollback_transaction(secretArn=credentials_arn, resourceArn=cluster_arn,
+            transactionId=current_transaction)
+        raise
+    finally:
+        current_transaction = None
+
+def with_retries(call, retry_resuming):
+    """
+    Runs a Data API call, retrying with exponential backoff and full jitter
+    while the cluster resumes from auto-pause. Throttling is retried by
+    botocore itself.
+    """
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except botocore.exceptions.ClientError as e:
+            attempt += 1
+            error = '{} {}'.format(e.response['Error'].get('Code'), e.response['Error'].get('Message'))
+            if not retry_resuming or attempt >= max_call_attempts or not any(r in error for r in RESUMING_ERRORS):
+                raise
+            delay = random.uniform(0, min(10, 0.5 * 2 ** attempt))
+            logger.warning(f'Database is resuming, retrying in {delay:.2f}s.')
+            time.sleep(delay)
+
+def get_connection():
+    global connection
+
+    if connection is None:
+        if pymysql is None:
+            raise RuntimeError('DB_HOST is set but pymysql is not packaged with the function')
+
+        secret = boto3.client('secretsmanager', config=aws_config).get_secret_value(SecretId=credentials_arn)
+        credentials = json.loads(secret['SecretString'])
+        connection = pymysql.connect(host=db_host, port=db_port, database=db_name,
+            user=credentials['username'], password=credentials['password'],
+            autocommit=True, connect_timeout=5)
+
+    return connection
+
+def reset_connection():
+    global connection
+
+    try:
+        connection.close()
+    except Exception:
+        pass
+    connection = None
+
+def driver_execute(sql, sql_parameters):
+    """
+    Runs a statement written for the Data API (":name" placeholders and
+    typed parameters) over the MySQL connection and returns the result in
+    the Data API response shape.
+    """
+    args = {p['name']: from_field(p['value']) for p in sql_parameters}
+    query = re.sub(r'(?<!:):(\w+)', r'%(\1)s', sql.replace('%', '%%'))
+
+    try:
+        updated, rows = run_query(query, args)
+    except pymysql.err.OperationalError as e:
+        # instead of pinging before every statement, reconnect and retry once
+        # when the connection turns out to be stale. inside a transaction the
+        # earlier statements are lost with the connection, so fail instead.
+        if current_transaction is not None or e.args[0] not in STALE_CONNECTION_ERRORS:
+            raise
+        logger.warning(f'Database connection went stale, reconnecting: {e}')
+        reset_connection()
+        updated, rows = run_query(query, args)
+
+    return {
+        'numberOfRecordsUpdated': updated if not rows else 0,
+        'records': [[to_field(v) for v in row] for row in rows]
+    }
+
+def run_query(query, args):
+    with get_connection().cursor() as cursor:
+        updated = cursor.execute(query, args)
+        rows = cursor.fetchall() if cursor.description else []
+    return updated, rows
+
+def from_field(field):
+    if field.get('isNull'):
+        return None
+    return next(iter(field.values()))
+
+def to_field(value):
+    if value is None:
+        return {'isNull': True}
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    if isinstance(value, int):
+        return {'longValue': value}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
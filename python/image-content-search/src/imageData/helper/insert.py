@@ -1,29 +1,67 @@
+from contextlib import nullcontext
 
-from helper import batch_execute_statement, logger  # type: ignore
+from helper import execute_statement, transaction, logger  # type: ignore
 
 # this module
-# adds a new image data to the database
+# adds new image data to the database
+# all labels of one or more images are written with multi-row upserts,
+# so re-delivered events don't fail on the primary key
+# statements of a multi-statement write share one transaction
+
+# keep each statement well below the Data API limits
+MAX_ROWS_PER_STATEMENT = 500
+MAX_STATEMENT_BYTES = 60000
 
 def insert_new_image(image_id, labels):
+    return insert_new_images([{"image_id": image_id, "labels": labels}])
 
-    statement = 'INSERT INTO tags (image_id, label) values (:image_id, :label)'
-    params_sets = []
+def insert_new_images(images):
+    rows = []
+    for image in images:
+        # the primary key is (image_id, label), so a repeated label would fail the statement
+        for l in dict.fromkeys(image["labels"]):
+            rows.append((image["image_id"], l))
+    rows = list(dict.fromkeys(rows))
 
-    for l in labels:
-        params_sets.append([
-                {'name':'image_id', 'value':{'stringValue': image_id}},
-                {'name':'label', 'value':{'stringValue': l}}
-        ])
+    statements = [build_upsert(chunk) for chunk in chunk_rows(rows)]
 
-    response = batch_execute_statement(statement, params_sets)
+    records_updated = 0
+    with transaction() if len(statements) > 1 else nullcontext():
+        for statement, parameters in statements:
+            response = execute_statement(statement, parameters)
+            records_updated += response.get("numberOfRecordsUpdated", 0)
 
-    logger.info(f'Number of records updated: {len(response["updateResults"])}')
+    logger.info(f'Number of rows written: {len(rows)}, records updated: {records_updated}')
 
-    return response
+    return {"rows": len(rows), "numberOfRecordsUpdated": records_updated}
 
+def chunk_rows(rows):
+    chunk = []
+    size = 0
 
+    for row in rows:
+        # rough size of one "(:image_id_N, :label_N)" tuple plus its parameter values
+        row_size = 40 + len(row[0]) + len(row[1].encode('utf-8'))
+        if chunk and (len(chunk) >= MAX_ROWS_PER_STATEMENT or size + row_size > MAX_STATEMENT_BYTES):
+            yield chunk
+            chunk = []
+            size = 0
+        chunk.append(row)
+        size += row_size
 
+    if chunk:
+        yield chunk
 
+def build_upsert(rows):
+    values = []
+    parameters = []
 
+    for n, (image_id, label) in enumerate(rows):
+        values.append(f'(:image_id_{n}, :label_{n})')
+        parameters.append({'name': f'image_id_{n}', 'value': {'stringValue': image_id}})
+        parameters.append({'name': f'label_{n}', 'value': {'stringValue': label}})
 
+    statement = ('INSERT INTO tags (image_id, label) VALUES ' + ', '.join(values) +
+        ' ON DUPLICATE KEY UPDATE label = VALUES(label)')
 
+    return statement, parameters
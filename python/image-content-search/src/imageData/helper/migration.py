@@ -10,11 +10,25 @@ def create_schema():
         CREATE TABLE IF NOT EXISTS tags
         (image_id VARCHAR(40) NOT NULL, label VARCHAR(64) NOT NULL,
         PRIMARY KEY (image_id, label),
-        INDEX (image_id, label));
+        INDEX (image_id, label),
+        INDEX label_image (label, image_id));
     """
 
+    # searches filter by label, so they need an index with label as the
+    # leading column; tables created before it existed get it added here
+    # (the schema custom resource re-runs this when SCHEMA_VERSION in
+    # stack/cdk.py is bumped)
+    find_label_index = """
+        SELECT COUNT(*) FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = 'tags' AND index_name = 'label_image';
+    """
+    create_label_index = "CREATE INDEX label_image ON tags (label, image_id);"
+
     try:
         execute_statement(create_table_and_index)
+        response = execute_statement(find_label_index)
+        if response["records"][0][0]["longValue"] == 0:
+            execute_statement(create_label_index)
         response = execute_statement("SHOW TABLES;")
         logger.info(f'List of tables: {response}')
     except Exception as e:
@@ -0,0 +1,87 @@
+import base64
+import binascii
+import json
+from urllib.parse import parse_qsl
+
+# this module
+# decodes the parameters of an API Gateway request from its query string and
+# its body (form-urlencoded or JSON, optionally base64 encoded)
+# malformed requests raise BadRequest so they are answered with a 4xx
+# instead of an error that clients retry
+
+MAX_BODY_BYTES = 16 * 1024
+MAX_FIELDS = 32
+
+class BadRequest(Exception):
+
+    def __init__(self, message, status_code = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def response(self):
+        return {
+            'statusCode': self.status_code,
+            'headers': {
+                'Content-Type': 'application/json; charset=UTF-8'
+            },
+            'body': json.dumps({'message': str(self)})
+        }
+
+def decode_request(event):
+    # API Gateway has already decoded the query string
+    params = dict(event.get('queryStringParameters') or {})
+
+    body = event.get('body')
+    if body:
+        params.update(decode_body(body, event.get('isBase64Encoded', False), get_content_type(event)))
+
+    return params
+
+def get_content_type(event):
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'content-type':
+            return value.split(';')[0].strip().lower()
+    return ''
+
+def decode_body(body, is_base64_encoded, content_type):
+    # check the size before doing any work on the body
+    if len(body) > (MAX_BODY_BYTES * 4 // 3 + 4 if is_base64_encoded else MAX_BODY_BYTES):
+        raise BadRequest('request body is too large', 413)
+
+    try:
+        if is_base64_encoded:
+            body = base64.b64decode(body, validate=True).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError):
+        raise BadRequest('request body is not valid base64 encoded UTF-8')
+
+    # browsers may label a form-encoded body as JSON, so look at the body itself
+    if content_type == 'application/json' and body.lstrip().startswith('{'):
+        return decode_json(body)
+
+    try:
+        fields = parse_qsl(body, keep_blank_values=True, strict_parsing=True, max_num_fields=MAX_FIELDS)
+    except ValueError:
+        raise BadRequest('request body is not valid form data')
+
+    return dict(fields)
+
+def decode_json(body):
+    try:
+        fields = json.loads(body)
+    except ValueError:
+        raise BadRequest('request body is not valid JSON')
+
+    if not isinstance(fields, dict) or len(fields) > MAX_FIELDS:
+        raise BadRequest('request body must be a JSON object with at most {} fields'.format(MAX_FIELDS))
+
+    params = {}
+    for key, value in fields.items():
+        if isinstance(value, list) and all(isinstance(v, str) for v in value):
+            value = ','.join(value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            value = str(value)
+        elif not isinstance(value, str):
+            raise BadRequest('field {} must be a string'.format(key))
+        params[key] = value
+
+    return params
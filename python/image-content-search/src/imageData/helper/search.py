@@ -1,10 +1,14 @@
 import boto3
 import botocore
+import botocore.exceptions
 import os
 import logging
 import json
+import time
+from collections import OrderedDict
 
 from helper import execute_statement, logger  # type: ignore
+from helper.request import BadRequest  # type: ignore
 
 aws_config = botocore.config.Config(
     region_name = os.getenv('REGION'),
@@ -18,18 +22,50 @@ aws_config = botocore.config.Config(
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+translate_client = boto3.client(service_name='translate', config=aws_config)
+dynamodb_client = boto3.client(service_name='dynamodb', config=aws_config)
+
+# translations are cached in memory and, optionally, in a DynamoDB table
+translation_cache = OrderedDict()
+translation_cache_size = int(os.getenv('TRANSLATION_CACHE_SIZE') or '4096')
+translation_cache_table = os.getenv('TRANSLATION_CACHE_TABLE')
+translation_cache_ttl_seconds = int(os.getenv('TRANSLATION_CACHE_TTL_DAYS') or '30') * 86400
+
+# Amazon Translate errors caused by the language or the label of the request
+TRANSLATE_REQUEST_ERRORS = ('UnsupportedLanguagePairException', 'ValidationException',
+    'InvalidRequestException', 'TextSizeLimitExceededException')
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 500
+MAX_LABELS = 20
+
 # this module
 # looks for images in the database
 # translates the keywords if needed
+# several labels can be searched at once, matching images with all of them
+# ("all") or any of them ("any"); results are ordered by image id and paged
+# with a keyset cursor: pass the X-Next-Cursor response header as "after"
 
-def search_label(label, country = None, language = None):
-    if language and language != 'en':
-        translated_label = translate(language, label)
-        logger.info("Translated label {} ({}) to {} (en).".format(label, language, translated_label))
-        label = translated_label
+def search_label(label, country = None, language = None, match = 'all', limit = DEFAULT_LIMIT, after = None):
+    labels = [l.strip() for l in label.split(',') if l.strip()][:MAX_LABELS]
+    limit = max(1, min(int(limit), MAX_LIMIT))
 
-    statement = "SELECT image_id FROM tags WHERE label=:label"
-    parameters = [{'name':'label', 'value':{'stringValue': label.lower()}}]
+    if language and language != 'en':
+        translated_labels = [translate(language, l) for l in labels]
+        logger.info("Translated labels {} ({}) to {} (en).".format(labels, language, translated_labels))
+        labels = translated_labels
+
+    labels = list(dict.fromkeys(l.lower() for l in labels))
+    if not labels:
+        return {
+            'statusCode': 400,
+            'headers': {
+                'Content-Type': 'application/json; charset=UTF-8'
+            },
+            'body': json.dumps({'message': 'at least one label is required'})
+        }
+
+    statement, parameters = build_search(labels, match, limit, after)
     result = execute_statement(statement, parameters)
 
     logger.info(result)
@@ -42,26 +78,93 @@ def search_label(label, country = None, language = None):
                 "id": item["stringValue"]
             })
 
+    headers = {
+        'Content-Type': 'application/json; charset=UTF-8'
+    }
+    if len(response) == limit:
+        headers['X-Next-Cursor'] = response[-1]["id"]
+        headers['Access-Control-Expose-Headers'] = 'X-Next-Cursor'
+
     return {
         'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json; charset=UTF-8'
-        },
+        'headers': headers,
         'body': json.dumps(response)
     }
 
-def translate(language, word):
-    translate = boto3.client(service_name='translate', config=aws_config)
-    result = translate.translate_text(Text=word, SourceLanguageCode=language, TargetLanguageCode="en")
-
-    return result.get('TranslatedText')
+def build_search(labels, match, limit, after):
+    # every query is a range scan of the (label, image_id) index per label
+    placeholders = ', '.join(':label_{}'.format(n) for n in range(len(labels)))
+    parameters = [{'name':'label_{}'.format(n), 'value':{'stringValue': l}} for n, l in enumerate(labels)]
+    parameters.append({'name':'limit', 'value':{'longValue': limit}})
+
+    keyset = ''
+    if after:
+        keyset = ' AND image_id > :after'
+        parameters.append({'name':'after', 'value':{'stringValue': after}})
+
+    if match == 'any' or len(labels) == 1:
+        statement = ("SELECT DISTINCT image_id FROM tags WHERE label IN ({}){} "
+            "ORDER BY image_id LIMIT :limit").format(placeholders, keyset)
+    else:
+        # (image_id, label) is the primary key, so an image that has all the
+        # labels has exactly one row per label
+        statement = ("SELECT image_id FROM tags WHERE label IN ({}){} "
+            "GROUP BY image_id HAVING COUNT(*) = :label_count "
+            "ORDER BY image_id LIMIT :limit").format(placeholders, keyset)
+        parameters.append({'name':'label_count', 'value':{'longValue': len(labels)}})
+
+    return statement, parameters
 
+def translate(language, word):
+    term = '{}#{}'.format(language, word.lower())
+
+    # 1- in-process cache
+    if term in translation_cache:
+        translation_cache.move_to_end(term)
+        return translation_cache[term]
+
+    # 2- shared cache table
+    translated = get_cached_translation(term)
+
+    # 3- Amazon Translate
+    if translated is None:
+        try:
+            result = translate_client.translate_text(Text=word, SourceLanguageCode=language, TargetLanguageCode="en")
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in TRANSLATE_REQUEST_ERRORS: raise
+            raise BadRequest("unable to translate '{}' from language '{}'".format(word, language))
+        translated = result.get('TranslatedText')
+        put_cached_translation(term, translated)
+
+    translation_cache[term] = translated
+    while len(translation_cache) > translation_cache_size:
+        translation_cache.popitem(last=False)
+
+    return translated
+
+def get_cached_translation(term):
+    if not translation_cache_table: return None
+
+    try:
+        item = dynamodb_client.get_item(TableName=translation_cache_table, Key={'term': {'S': term}}).get('Item')
+    except Exception as e:
+        logger.warning('Translation cache lookup failed: {}'.format(e))
+        return None
+
+    # expired items may linger until DynamoDB deletes them
+    if item is None or int(item['expires_at']['N']) < time.time():
+        return None
+    return item['english']['S']
+
+def put_cached_translation(term, translated):
+    if not translation_cache_table: return
+
+    try:
+        dynamodb_client.put_item(TableName=translation_cache_table, Item={
+            'term': {'S': term},
+            'english': {'S': translated},
+            'expires_at': {'N': str(int(time.time()) + translation_cache_ttl_seconds)}
+        })
+    except Exception as e:
+        logger.warning('Translation cache update failed: {}'.format(e))
 
-def get_http_params(body):
-    params = {}
-
-    for param in body.split('&'):
-        key, value = param.split('=')
-        params[key] = value
-
-    return params
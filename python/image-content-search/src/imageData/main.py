@@ -1,6 +1,9 @@
-from helper.insert import insert_new_image  # type: ignore
+import re
+
+from helper.insert import insert_new_images  # type: ignore
 from helper.migration import create_schema  # type: ignore
-from helper.search import search_label, get_http_params  # type: ignore
+from helper.search import search_label, MAX_LIMIT  # type: ignore
+from helper.request import decode_request, BadRequest  # type: ignore
 
 # this function
 # based on the source:
@@ -17,22 +20,54 @@ def handler(event, context):
         for k in body: event[k] = body[k]
 
     if "body" in event:
-        body = get_http_params(event["body"])
-        for k in body: event[k] = body[k]
+        try:
+            return search(decode_request(event))
+        except BadRequest as e:
+            return e.response()
 
     source = event["source"]
 
     if source == "Cloudformation": # Cloudformation => create schema
         return create_schema()
     elif source == "EventBridge": # Event Bridge => image labels
-        image_id = event["detail"]["image_id"]
-        labels = event["detail"]["labels"]
-        response = insert_new_image(image_id, labels)
+        # a detail holds either a single image or a batch of "images"
+        detail = event["detail"]
+        images = detail["images"] if "images" in detail else [detail]
+        response = insert_new_images(images)
         return response
     elif source == "API": #API Gateway => search
-        if "language" in event:
-            response = search_label(event["label"], event["country"], event["language"])
-        else:
-            response = search_label(event["label"])
+        try:
+            return search(event)
+        except BadRequest as e:
+            return e.response()
+
+def search(params):
+    if not params.get("label"):
+        raise BadRequest("label is required")
+
+    options = {"label": params["label"]}
+
+    if params.get("language"):
+        # language codes like "fr" or "zh-TW", as accepted by Amazon Translate
+        if not re.fullmatch(r"[a-z]{2,3}(-[A-Za-z]{2})?", params["language"]):
+            raise BadRequest("language must be a language code such as 'fr' or 'zh-TW'")
+        options["language"] = params["language"]
+        options["country"] = params.get("country")
+
+    if params.get("match"):
+        if params["match"] not in ("all", "any"):
+            raise BadRequest("match must be 'all' or 'any'")
+        options["match"] = params["match"]
+
+    if params.get("limit"):
+        try:
+            options["limit"] = int(params["limit"])
+        except ValueError:
+            raise BadRequest("limit must be a number")
+        if not 0 < options["limit"] <= MAX_LIMIT:
+            raise BadRequest("limit must be between 1 and {}".format(MAX_LIMIT))
+
+    if params.get("after"):
+        options["after"] = params["after"]
 
-        return response
\ No newline at end of file
+    return search_label(**options)
\ No newline at end of file
@@ -1,84 +1,238 @@
 import boto3
 import os
 import logging
+import random
 import hashlib
 import json
-import botocore
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 queue_name = os.environ["ICS_IMAGE_MASSAGE"]
-sqs = boto3.resource('sqs')
+images_index_table = os.environ["ICS_IMAGES_INDEX"]
+max_workers = int(os.getenv("MAX_WORKERS") or '8')
+# seconds after which a pending claim whose invocation never finished is
+# considered abandoned; must be longer than the function timeout
+claim_timeout = int(os.getenv("CLAIM_TIMEOUT") or '60')
+# attempts for a batch request whose keys DynamoDB leaves unprocessed
+batch_max_attempts = 8
+
+# clients (unlike resources) are thread-safe and shared by the workers
+s3 = boto3.client('s3')
+sqs = boto3.client('sqs')
+dynamodb = boto3.client('dynamodb')
+
+# resolve the queue URL once per container
+queue_url = os.getenv("ICS_IMAGE_QUEUE_URL") or sqs.get_queue_url(QueueName=queue_name)['QueueUrl']
 
 # this function
-# downloads the image from S3
-# calculates the SHA1 hash checksum to prevent re-analysing images
-# renames the object with prefix "processed"
-# adds the metadata to SQS queue
-# deletes the local copy
+# streams the image from S3 and calculates the SHA1 hash checksum on the fly
+# checks all hashes of the batch against the images index at once
+# to prevent re-analysing images
+# a hash is claimed as "pending" first and only marked "processed" once its
+# message is queued, so an invocation that dies in between does not block it
+# copies the object to the prefix "processed"
+# adds the metadata of the whole batch to SQS queue, 10 messages per call
+# deletes the original object
+# records in a batch are processed concurrently
 
 def handler(event, context):
-    s3 = boto3.resource('s3')
+    images = [i for i in runConcurrently(hashRecord, event['Records']) if i is not None]
+
+    # keep one image per content hash; already processed content and
+    # duplicates within the batch are dropped
+    processed = getProcessedHashes({i['sha1'] for i in images})
+    new_images = {}
+    duplicates = []
+    for image in images:
+        if image['sha1'] in processed or image['sha1'] in new_images:
+            duplicates.append(image)
+        else:
+            new_images[image['sha1']] = image
 
-    for record in event['Records']:
-        newKey = record['s3']['object']['key']
-        bucket = record['s3']['bucket']['name']
-        name = bucket.split("/")[-1]
-        localfile = "/tmp/{}".format(name)
+    claimed = [i for i in runConcurrently(claimImage, list(new_images.values())) if i is not None]
 
-        # download the file
-        new_key_obj = s3.Object(bucket, newKey)
-        new_key_obj.download_file(localfile)
+    # a failed copy only holds back its own image; the rest are still queued
+    copied = []
+    copy_failed = []
+    for image, ok in zip(claimed, runConcurrently(copyImage, claimed)):
+        (copied if ok else copy_failed).append(image)
+    releaseClaims(copy_failed)
 
-        # calc hash
-        image_SHA1 = getSha1(localfile)
+    sent, failed = sendMessages(copied)
+    runConcurrently(markProcessed, sent)
+    runConcurrently(deleteOriginal, sent)
+    runConcurrently(deleteDuplicate, duplicates)
 
-        # check if not exist
-        processed_key = "processed/{}/{}".format(image_SHA1[:2], image_SHA1)
-        key_is_processed = isS3ObjectExist(bucket, processed_key)
-        if key_is_processed: continue
+    failed = copy_failed + failed
+    if failed:
+        raise Exception('Failed to process {} image(s): {}'.format(len(failed), [i['key'] for i in failed]))
 
-        # add to the queue
-        message = json.dumps({
-            "image": processed_key,
-            "original_key": newKey,
-            "original_last_modified": new_key_obj.last_modified,
-            "etag": new_key_obj.e_tag
-        }, default=str)
+    return True
 
-        queue = sqs.get_queue_by_name(QueueName=queue_name)
-        response = queue.send_message(MessageBody=message)
-        logger.info("Message {} has been sent.".format(response.get('MessageId')))
+def runConcurrently(function, items):
+    if not items: return []
 
-        #move the image
-        s3.Object(bucket, processed_key).copy_from(CopySource="{}/{}".format(bucket,newKey))
-        new_key_obj.delete()
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [executor.submit(function, item) for item in items]
 
-        # delete local file
-        os.remove(localfile)
+    # let every item finish before failing the invocation
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    if errors:
+        raise errors[0]
 
-    return True
+    return [f.result() for f in futures]
 
-def isS3ObjectExist(bucket, key):
-    s3 = boto3.resource('s3')
+def hashRecord(record):
+    newKey = unquote_plus(record['s3']['object']['key'])
+    bucket = record['s3']['bucket']['name']
 
+    # stream the file straight into the hasher
     try:
-        s3.Object(bucket,key)
-        return False
-    except botocore.exceptions.ClientError as e:
-        if e.response['Error']['Code'] == "404":
-            return True
+        new_key_obj = s3.get_object(Bucket=bucket, Key=newKey)
+    except s3.exceptions.NoSuchKey:
+        logger.info("{} has already been processed.".format(newKey))
+        return None
+
+    return {
+        "bucket": bucket,
+        "key": newKey,
+        "sha1": getSha1(new_key_obj['Body']),
+        "last_modified": new_key_obj['LastModified'],
+        "etag": new_key_obj['ETag']
+    }
+
+def getProcessedHashes(hashes):
+    # BatchGetItem accepts up to 100 keys per call
+    hashes = list(hashes)
+    processed = set()
+
+    for i in range(0, len(hashes), 100):
+        request = {images_index_table: {
+            'Keys': [{'sha1': {'S': h}} for h in hashes[i:i + 100]],
+            'ProjectionExpression': 'sha1, #status',
+            'ExpressionAttributeNames': {'#status': 'status'}
+        }}
+        for attempt in range(batch_max_attempts):
+            response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(images_index_table, []):
+                # pending claims are settled by claimImage
+                if item.get('status', {}).get('S') != 'pending':
+                    processed.add(item['sha1']['S'])
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            # back off with jitter while the table is throttled
+            time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
         else:
-            raise e
+            raise Exception('Images index lookup did not complete after {} attempts'.format(batch_max_attempts))
+
+    return processed
+
+def claimImage(image):
+    image['processed_key'] = "processed/{}/{}".format(image['sha1'][:2], image['sha1'])
+
+    # claim the hash; a concurrent invocation may have claimed it already.
+    # a pending claim can be taken over when it is our own (an earlier attempt
+    # for the same object) or when it is stale (its invocation died)
+    now = int(time.time())
+    try:
+        dynamodb.put_item(TableName=images_index_table,
+            Item={
+                'sha1': {'S': image['sha1']},
+                'image': {'S': image['processed_key']},
+                'status': {'S': 'pending'},
+                'original_key': {'S': image['key']},
+                'claimed_at': {'N': str(now)}
+            },
+            ConditionExpression='attribute_not_exists(sha1) OR '
+                '(#status = :pending AND (original_key = :key OR claimed_at < :stale))',
+            ExpressionAttributeNames={'#status': 'status'},
+            ExpressionAttributeValues={
+                ':pending': {'S': 'pending'},
+                ':key': {'S': image['key']},
+                ':stale': {'N': str(now - claim_timeout)}
+            })
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        deleteDuplicate(image)
+        return None
+
+    return image
+
+def sendMessages(images):
+    sent = []
+    failed = []
+
+    # SendMessageBatch accepts up to 10 messages per call
+    for i in range(0, len(images), 10):
+        chunk = images[i:i + 10]
+        entries = [{
+            "Id": str(n),
+            "MessageBody": json.dumps({
+                "image": image['processed_key'],
+                "original_key": image['key'],
+                "original_last_modified": image['last_modified'],
+                "etag": image['etag']
+            }, default=str)
+        } for n, image in enumerate(chunk)]
+
+        try:
+            response = sqs.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        except Exception as e:
+            logger.error("Failed to send messages: {}".format(e))
+            failed.extend(chunk)
+            continue
+
+        for entry in response.get('Successful', []):
+            logger.info("Message {} has been sent.".format(entry['MessageId']))
+            sent.append(chunk[int(entry['Id'])])
+        for entry in response.get('Failed', []):
+            logger.error("Failed to send message for {}: {}".format(chunk[int(entry['Id'])]['key'], entry.get('Message')))
+            failed.append(chunk[int(entry['Id'])])
+
+    releaseClaims(failed)
+
+    return sent, failed
+
+def markProcessed(image):
+    dynamodb.update_item(TableName=images_index_table,
+        Key={'sha1': {'S': image['sha1']}},
+        UpdateExpression='SET #status = :processed REMOVE claimed_at',
+        ExpressionAttributeNames={'#status': 'status'},
+        ExpressionAttributeValues={':processed': {'S': 'processed'}})
+
+def releaseClaims(images):
+    # release the claims so a retry processes the images again
+    for image in images:
+        dynamodb.delete_item(TableName=images_index_table, Key={'sha1': {'S': image['sha1']}})
+
+def copyImage(image):
+    bucket = image['bucket']
+
+    try:
+        s3.copy_object(Bucket=bucket, Key=image['processed_key'], CopySource={'Bucket': bucket, 'Key': image['key']})
+    except Exception as e:
+        logger.error("Failed to copy {}: {}".format(image['key'], e))
+        return False
+
+    return True
+
+def deleteOriginal(image):
+    s3.delete_object(Bucket=image['bucket'], Key=image['key'])
+
+def deleteDuplicate(image):
+    logger.info("{} has already been analysed, skipping.".format(image['key']))
+    s3.delete_object(Bucket=image['bucket'], Key=image['key'])
 
-def getSha1(filepath):
+def getSha1(body):
     sha1 = hashlib.sha1()
 
-    with open(filepath, 'rb') as f:
-        while True:
-            data = f.read(65536) # read in 64kb chunks
-            if not data: break
-            sha1.update(data)
+    while True:
+        data = body.read(65536) # read in 64kb chunks
+        if not data: break
+        sha1.update(data)
 
-    return sha1.hexdigest()
\ No newline at end of file
+    return sha1.hexdigest()
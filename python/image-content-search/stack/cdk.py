@@ -7,6 +7,7 @@ from aws_cdk import (
     aws_s3 as _s3,
     aws_cognito as _cognito,
     aws_sqs as _sqs,
+    aws_dynamodb as _dynamodb,
     aws_iam as _iam,
     aws_events as _events,
     aws_events_targets as _event_targets,
@@ -44,6 +45,11 @@ from aws_cdk.custom_resources import (
 
 from constructs import Construct
 
+# version of the database schema in src/imageData/helper/migration.py; bump it
+# whenever the migration changes, so CloudFormation sends an Update to the
+# schema custom resource and the migration runs on existing stacks too
+SCHEMA_VERSION = "2"
+
 class ImageContentSearchStack(Stack):
 
     def __init__(self, scope: Construct, id: str, **kwargs) -> None:
@@ -163,15 +169,26 @@ class ImageContentSearchStack(Stack):
 
         images_S3_bucket.grant_put(get_signedurl_function, objects_key_pattern="new/*")
 
+        ### images index (SHA1 of every image that has been sent for analysis)
+        images_index_table = _dynamodb.Table(self, "ICS_IMAGES_INDEX",
+            partition_key=_dynamodb.Attribute(name="sha1", type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST)
+
         ### image massage function
         image_massage_function = Function(self, "ICS_IMAGE_MASSAGE",
             function_name="ICS_IMAGE_MASSAGE",
             timeout=Duration.seconds(6),
             runtime=Runtime.PYTHON_3_7,
-            environment={"ICS_IMAGE_MASSAGE": image_queue.queue_name},
+            environment={
+                "ICS_IMAGE_MASSAGE": image_queue.queue_name,
+                "ICS_IMAGE_QUEUE_URL": image_queue.queue_url,
+                "ICS_IMAGES_INDEX": images_index_table.table_name
+                },
             handler="main.handler",
             code=Code.from_asset("./src/imageMassage"))
 
+        images_index_table.grant_read_write_data(image_massage_function)
+
         images_S3_bucket.grant_write(image_massage_function, "processed/*")
         images_S3_bucket.grant_delete(image_massage_function, "new/*")
         images_S3_bucket.grant_read(image_massage_function, "new/*")
@@ -198,7 +215,9 @@ class ImageContentSearchStack(Stack):
             handler="main.handler",
             code=Code.from_asset("./src/imageAnalysis"))
 
-        image_analyzer_function.add_event_source(_lambda_event_source.SqsEventSource(queue=image_queue, batch_size=10))
+        image_analyzer_function.add_event_source(_lambda_event_source.SqsEventSource(queue=image_queue,
+            batch_size=10,
+            report_batch_item_failures=True))
         image_queue.grant_consume_messages(image_massage_function)
 
         lambda_rekognition_access = _iam.PolicyStatement(
@@ -208,6 +227,14 @@ class ImageContentSearchStack(Stack):
         )
 
         image_analyzer_function.add_to_role_policy(lambda_rekognition_access)
+
+        ### label cache (Rekognition results by image SHA1 and model parameters)
+        label_cache_table = _dynamodb.Table(self, "ICS_LABEL_CACHE",
+            partition_key=_dynamodb.Attribute(name="cache_key", type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST)
+
+        label_cache_table.grant_read_write_data(image_analyzer_function)
+        image_analyzer_function.add_environment("ICS_LABEL_CACHE_TABLE", label_cache_table.table_name)
         images_S3_bucket.grant_read(image_analyzer_function, "processed/*")
 
         ### API gateway finalizing
@@ -318,6 +345,15 @@ class ImageContentSearchStack(Stack):
 
         image_data_function.add_to_role_policy(lambda_access_search)
 
+        ### translation cache ("<language>#<word>" => english, expired by TTL)
+        translation_cache_table = _dynamodb.Table(self, "ICS_TRANSLATION_CACHE",
+            partition_key=_dynamodb.Attribute(name="term", type=_dynamodb.AttributeType.STRING),
+            billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires_at")
+
+        translation_cache_table.grant_read_write_data(image_data_function)
+        image_data_function.add_environment("TRANSLATION_CACHE_TABLE", translation_cache_table.table_name)
+
         ### custom resource
         lambda_provider = Provider(self, 'ICS_IMAGE_DATA_PROVIDER',
             on_event_handler=image_data_function
@@ -328,7 +364,8 @@ class ImageContentSearchStack(Stack):
             pascal_case_properties=False,
             resource_type="Custom::SchemaCreation",
             properties={
-                "source": "Cloudformation"
+                "source": "Cloudformation",
+                "schemaVersion": SCHEMA_VERSION
             }
         )
 
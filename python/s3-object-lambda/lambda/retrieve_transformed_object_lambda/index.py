@@ -1,72 +1,210 @@
-import hashlib
+import itertools
 import json
-import urllib
+import re
+import socket
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
 from dataclasses import dataclass
-from email.message import Message
 
 import boto3
+import botocore.config
+import urllib3
+from urllib3.connection import HTTPConnection
 
-client = boto3.client('s3')
+from transforms import (CHUNK_SIZE, MAX_RANGE_BYTES, TRANSFORM_ERRORS, ChunkStream, build_pipeline, parse_range,
+                        read_range, run_pipeline, take_tail)
+
+# the response body is streamed as it is produced, so it cannot be hashed
+# up front for the request signature
+client = boto3.client('s3', config=botocore.config.Config(s3={'payload_signing_enabled': False}))
+
+# keep-alive connections to S3 reused across invocations, so only a cold
+# start pays for the TCP and TLS handshakes. urllib3 ships with botocore.
+http = urllib3.PoolManager(
+    timeout=urllib3.Timeout(connect=2.0, read=30.0),
+    retries=urllib3.Retry(total=3, backoff_factor=0.1, status_forcelist=(500, 502, 503, 504),
+                          raise_on_status=False),
+    # a larger receive buffer keeps the window open while a chunk is transformed
+    socket_options=HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, CHUNK_SIZE),
+    ],
+)
+
+# transform chain used when the access point passes no payload
+DEFAULT_TRANSFORMS = [{"name": "digest"}]
+
+# S3 error code for a status when the error body cannot be read
+ERROR_CODES = {
+    400: "InvalidRequest",
+    403: "AccessDenied",
+    404: "NoSuchKey",
+    412: "PreconditionFailed",
+    416: "InvalidRange",
+    500: "InternalError",
+    503: "ServiceUnavailable",
+}
+
+# error bodies are small XML documents; never read more than this
+MAX_ERROR_BYTES = 64 * 1024
 
 
 @dataclass
 class Response:
     status: int
-    headers: Message
+    error_code: str
     body: str
 
 
+def get_error(status: int, body: bytes) -> Response:
+    """
+    Reads the S3 error code and message from an error response, so they
+    can be passed on to the caller unchanged.
+    """
+    code = ERROR_CODES.get(status, "InternalError" if status >= 500 else "InvalidRequest")
+    message = ""
+    try:
+        error = ElementTree.fromstring(body)
+        code = error.findtext("Code") or code
+        message = error.findtext("Message") or ""
+    except ElementTree.ParseError:
+        pass
+    return Response(status=status, error_code=code, body=message)
+
+
+def get_transforms(event) -> list:
+    """
+    Reads the transform chain from the payload configured on the Object
+    Lambda Access Point, e.g. {"transforms": [{"name": "gunzip"}, ...]}.
+    """
+    payload = event.get("configuration", {}).get("payload")
+    if not payload:
+        return DEFAULT_TRANSFORMS
+    return json.loads(payload).get("transforms", DEFAULT_TRANSFORMS)
+
+
+def get_user_request(event):
+    """Returns the Range header and partNumber of the original GET request."""
+    user_request = event.get("userRequest", {})
+    headers = {name.lower(): value for name, value in user_request.get("headers", {}).items()}
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(user_request.get("url", "")).query)
+    part_number = query.get("partNumber", [None])[0]
+    return headers.get("range"), part_number
+
+
 def handler(event, context):
     event_object = event["getObjectContext"]
     s3_url = event_object["inputS3Url"]
 
-    request = urllib.request.Request(
-        s3_url, method="GET"
-    )
+    try:
+        stages, content_type = build_pipeline(get_transforms(event))
+    except (ValueError, TypeError, KeyError, AttributeError, re.error) as e:
+        # a broken access point payload must still answer the GET request
+        response = Response(status=500, error_code="InternalError",
+                            body=f"Invalid transform configuration: {e!r}")
+        return write_error(event_object, response)
+    range_header, part_number = get_user_request(event)
+    byte_range = parse_range(range_header)
+
+    headers = {}
+    if not stages:
+        # Without transforms the output is the original object, so S3 can
+        # serve the range or part itself
+        if byte_range is not None:
+            headers["Range"] = range_header
+        if part_number is not None:
+            s3_url += f"&partNumber={urllib.parse.quote(part_number)}"
+    elif part_number is not None:
+        # Parts of the original object do not map onto parts of the output
+        response = Response(status=501, error_code="NotImplemented",
+                            body="partNumber is not supported for transformed objects")
+        return write_error(event_object, response)
 
     try:
-        with urllib.request.urlopen(request) as response:
-            response = Response(
-                status=response.status,
-                headers=response.headers,
-                body=response.read().decode(response.headers.get_content_charset("utf-8")),
-            )
-    except urllib.error.HTTPError as e:
-        response = Response(
-            status=e.code,
-            headers=e.headers,
-            body=str(e.reason),
-        )
+        original = http.request("GET", s3_url, headers=headers, preload_content=False)
+    except urllib3.exceptions.HTTPError as e:
+        return write_error(event_object, Response(status=503, error_code="ServiceUnavailable", body=str(e)))
 
-    if response.status != 200:
-        # Write object back to S3 Object Lambda with an error
-        output_response = client.write_get_object_response(
-            RequestRoute=event_object["outputRoute"],
-            RequestToken=event_object["outputToken"],
-            StatusCode=400,
-            ErrorCode="SomethingWentWrong", ErrorMessage=response.body)
-    else:
-        # Transform object to the desired result if the object retrieval was successful
-        transformed_object = {
-            "metadata": {
-                "length": len(response.body),
-                "md5": hashlib.md5(response.body.encode()).hexdigest(),
-                "sha1": hashlib.sha1(response.body.encode()).hexdigest(),
-                "sha256": hashlib.sha256(response.body.encode()).hexdigest()
-            }
-        }
+    try:
+        if original.status not in (200, 206):
+            return write_error(event_object, get_error(original.status, original.read(MAX_ERROR_BYTES)))
+
+        # Stream the original object through the transform chain and hand
+        # the result to S3 as it is produced. Content encodings are kept as
+        # stored, the gunzip stage decompresses explicitly.
+        chunks = run_pipeline(stages, original.stream(CHUNK_SIZE, decode_content=False))
+
+        kwargs = {}
+        try:
+            if stages and byte_range is not None:
+                # the length of the transformed object is not known up front,
+                # so the range is read first and reported as actually sent
+                first, last = byte_range
+                if first is None:
+                    # a suffix range needs the end of the output, so only
+                    # its last bytes are kept while the rest streams by
+                    body, total = take_tail(chunks, min(last, MAX_RANGE_BYTES))
+                    first = total - len(body)
+                else:
+                    body, total = read_range(chunks, first, last)
+                if not body:
+                    response = Response(status=416, error_code="InvalidRange",
+                                        body="The requested range is not satisfiable")
+                    return write_error(event_object, response)
+                chunks = [body]
+                kwargs["ContentLength"] = len(body)
+                kwargs["ContentRange"] = f"bytes {first}-{first + len(body) - 1}/{'*' if total is None else total}"
+                kwargs["StatusCode"] = 206
+            elif stages:
+                # run the transforms up to their first output, so an object
+                # they cannot handle is still answered with an error
+                chunks = iter(chunks)
+                chunks = itertools.chain([next(chunks, b"")], chunks)
+        except TRANSFORM_ERRORS as e:
+            response = Response(status=500, error_code="InternalError",
+                                body=f"Unable to transform object: {e!r}")
+            return write_error(event_object, response)
+        except urllib3.exceptions.HTTPError as e:
+            return write_error(event_object, Response(status=503, error_code="ServiceUnavailable", body=str(e)))
+
+        if not stages and original.status == 206:
+            kwargs["ContentRange"] = original.headers["Content-Range"]
+            kwargs["StatusCode"] = 206
+        if not stages and original.headers.get("Content-Length"):
+            kwargs["ContentLength"] = int(original.headers["Content-Length"])
 
         # Write object back to S3 Object Lambda with the transformed object
         output_response = client.write_get_object_response(
             RequestRoute=event_object["outputRoute"],
             RequestToken=event_object["outputToken"],
-            Body=json.dumps(transformed_object),
+            Body=ChunkStream(chunks),
+            ContentType=content_type or original.headers.get("Content-Type", "binary/octet-stream"),
+            **kwargs
         )
+    finally:
+        # hand the connection back to the pool for the next invocation. an
+        # unread remainder (after a range or an error) would corrupt the
+        # next response, so such a connection is closed first.
+        if original.length_remaining:
+            original.close()
+        original.release_conn()
+
+    print(f"Response: {json.dumps(output_response, default=str)}")
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"message": "Success"})
+    }
+
+
+def write_error(event_object, response: Response):
+    # Write object back to S3 Object Lambda with an error
+    output_response = client.write_get_object_response(
+        RequestRoute=event_object["outputRoute"],
+        RequestToken=event_object["outputToken"],
+        StatusCode=response.status,
+        ErrorCode=response.error_code, ErrorMessage=response.body)
 
-    print(f"Response: {json.dumps(output_response)}")
+    print(f"Response: {json.dumps(output_response, default=str)}")
     return {
         "statusCode": 200,
-        "body": json.dumps({
-            "message": "Success" if response.status == 200 else "Failed"
-        })
+        "body": json.dumps({"message": "Failed"})
     }
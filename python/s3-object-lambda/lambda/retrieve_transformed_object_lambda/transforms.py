@@ -0,0 +1,262 @@
+import csv
+import hashlib
+import io
+import json
+import re
+import zlib
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+# A stage takes an iterable of byte chunks and returns an iterable of byte
+# chunks. Stages are chained so an object flows through all of them one
+# chunk at a time and is never held in memory as a whole.
+Chunks = Iterable[bytes]
+Stage = Callable[[Chunks], Chunks]
+
+# size of the chunks read from the original object and of the blocks the
+# CSV projection writes
+CHUNK_SIZE = 1024 * 1024
+
+# the most bytes of transformed output served for one range request. The
+# end of the output is only known once it has been produced, so a range is
+# buffered before it is sent; a larger range is answered with its start.
+MAX_RANGE_BYTES = 8 * CHUNK_SIZE
+
+# errors the stages raise on objects they cannot transform, e.g. gunzip on
+# an object that is not gzip, or a CSV column or encoding that does not match
+TRANSFORM_ERRORS = (ValueError, LookupError, zlib.error, csv.Error)
+
+
+def digest(chunks: Chunks) -> Iterator[bytes]:
+    """
+    Replaces the object with a JSON summary of its length in bytes and its
+    MD5, SHA1 and SHA256 digests, computed in a single pass.
+    """
+    hashers = {
+        "md5": hashlib.md5(),
+        "sha1": hashlib.sha1(),
+        "sha256": hashlib.sha256(),
+    }
+    length = 0
+
+    for chunk in chunks:
+        length += len(chunk)
+        for hasher in hashers.values():
+            hasher.update(chunk)
+
+    metadata = {"length": length, **{name: hasher.hexdigest() for name, hasher in hashers.items()}}
+    yield json.dumps({"metadata": metadata}).encode("utf-8")
+
+
+def gunzip(chunks: Chunks) -> Iterator[bytes]:
+    """Decompresses a gzip object (including concatenated members)."""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # start over for the next gzip member
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def make_gzip(level: int = 6) -> Stage:
+    """Compresses the object with gzip at the given level."""
+    def gzip_stage(chunks: Chunks) -> Iterator[bytes]:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    return gzip_stage
+
+
+def iter_lines(chunks: Chunks) -> Iterator[List[bytes]]:
+    """
+    Regroups byte chunks into lists of complete lines (newlines included),
+    one list per incoming chunk, so line based stages can work a block at a
+    time instead of a line at a time.
+    """
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).splitlines(keepends=True)
+        pending = b""
+        if lines and not lines[-1].endswith((b"\n", b"\r")):
+            pending = lines.pop()
+        if lines:
+            yield lines
+    if pending:
+        yield [pending]
+
+
+def make_filter_lines(pattern: str, invert: bool = False) -> Stage:
+    """Keeps only the lines matching (or, inverted, not matching) a regex."""
+    regex = re.compile(pattern.encode("utf-8"))
+
+    def filter_lines(chunks: Chunks) -> Iterator[bytes]:
+        for lines in iter_lines(chunks):
+            kept = [line for line in lines if bool(regex.search(line)) != invert]
+            if kept:
+                yield b"".join(kept)
+    return filter_lines
+
+
+def make_redact(pattern: str, replacement: str = "****") -> Stage:
+    """Replaces every match of a regex with a fixed string, line by line."""
+    regex = re.compile(pattern.encode("utf-8"))
+    replacement_bytes = replacement.encode("utf-8")
+
+    def redact(chunks: Chunks) -> Iterator[bytes]:
+        for lines in iter_lines(chunks):
+            yield regex.sub(lambda _: replacement_bytes, b"".join(lines))
+    return redact
+
+
+def make_project_csv(columns: List, delimiter: str = ",", encoding: str = "utf-8") -> Stage:
+    """
+    Keeps only the given CSV columns, by header name or zero-based index.
+    The header row is always written when columns are selected by name.
+    """
+    def project_csv(chunks: Chunks) -> Iterator[bytes]:
+        text = io.TextIOWrapper(ChunkStream(chunks), encoding=encoding, newline="")
+        reader = csv.reader(text, delimiter=delimiter)
+        out = io.StringIO()
+        writer = csv.writer(out, delimiter=delimiter, lineterminator="\n")
+
+        indexes = [c for c in columns if isinstance(c, int)]
+        if len(indexes) != len(columns):
+            header = next(reader, None)
+            if header is None:
+                return
+            indexes = [c if isinstance(c, int) else header.index(c) for c in columns]
+            writer.writerow([header[i] for i in indexes])
+
+        for row in reader:
+            writer.writerow([row[i] if i < len(row) else "" for i in indexes])
+            if out.tell() >= CHUNK_SIZE:
+                yield out.getvalue().encode(encoding)
+                out.seek(0)
+                out.truncate()
+        if out.tell():
+            yield out.getvalue().encode(encoding)
+    return project_csv
+
+
+# stage name => (factory taking the stage options, content type of its output)
+# a content type of None keeps the content type of the original object
+STAGES = {
+    "digest": (lambda: digest, "application/json"),
+    "gunzip": (lambda: gunzip, "application/octet-stream"),
+    "gzip": (make_gzip, "application/gzip"),
+    "filter_lines": (make_filter_lines, None),
+    "redact": (make_redact, None),
+    "project_csv": (make_project_csv, "text/csv"),
+}
+
+
+def build_pipeline(config: List[dict]) -> Tuple[List[Stage], Optional[str]]:
+    """
+    Builds the stages from a list like [{"name": "gunzip"},
+    {"name": "filter_lines", "pattern": "ERROR"}] and returns them with the
+    content type of the final output (None if unchanged).
+    """
+    stages = []
+    content_type = None
+    for options in config:
+        options = dict(options)
+        name = options.pop("name")
+        if name not in STAGES:
+            raise ValueError(f"Unknown transform stage: {name}")
+        factory, stage_content_type = STAGES[name]
+        stages.append(factory(**options))
+        if stage_content_type is not None:
+            content_type = stage_content_type
+    return stages, content_type
+
+
+def run_pipeline(stages: List[Stage], chunks: Chunks) -> Chunks:
+    for stage in stages:
+        chunks = stage(chunks)
+    return chunks
+
+
+def parse_range(header: Optional[str]) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    """
+    Parses a single "bytes=" range into (first, last), where last is None
+    for an open range and first is None for a suffix range ("bytes=-N",
+    last then holds N). Returns None for anything S3 would ignore.
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header or "")
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first = int(match.group(1)) if match.group(1) else None
+    last = int(match.group(2)) if match.group(2) else None
+    if first is not None and last is not None and last < first:
+        return None
+    if first is None and last == 0:
+        return None
+    return first, last
+
+
+def read_range(chunks: Chunks, first: int, last: Optional[int]) -> Tuple[bytes, Optional[int]]:
+    """
+    Returns bytes first to last (inclusive, or to the end) of the output,
+    at most MAX_RANGE_BYTES of them, and the total output length if the
+    output ended before the range did (None otherwise). The bytes are empty
+    if the output ends before first.
+    """
+    end = first + MAX_RANGE_BYTES if last is None else min(last + 1, first + MAX_RANGE_BYTES)
+    parts = []
+    position = 0
+    for chunk in chunks:
+        if position + len(chunk) > first:
+            parts.append(chunk[max(first - position, 0):end - position])
+        position += len(chunk)
+        if position >= end:
+            return b"".join(parts), None
+    return b"".join(parts), position
+
+
+def take_tail(chunks: Chunks, length: int) -> Tuple[bytes, int]:
+    """
+    Returns the last length bytes of the output and the total output length,
+    for suffix ranges. At most length bytes are kept in memory.
+    """
+    tail = b""
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        tail = (tail + chunk)[-length:]
+    return tail, total
+
+
+class ChunkStream(io.RawIOBase):
+    """
+    Read-only file-like view of an iterable of byte chunks, so a pipeline
+    can be handed to APIs that expect a stream (such as the Body of
+    write_get_object_response) and is consumed as they read it.
+    """
+
+    def __init__(self, chunks: Chunks):
+        self.chunks = iter(chunks)
+        self.pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self.pending:
+            try:
+                self.pending = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
@@ -1,3 +1,5 @@
+import json
+
 from aws_cdk import (
     App,
     Aws,
@@ -12,6 +14,9 @@ from aws_cdk import (
 # configurable variables
 S3_ACCESS_POINT_NAME = "example-test-ap"
 OBJECT_LAMBDA_ACCESS_POINT_NAME = "s3-object-lambda-ap"
+# transform chain applied by the lambda, e.g.
+# [{"name": "gunzip"}, {"name": "filter_lines", "pattern": "ERROR"}, {"name": "gzip"}]
+TRANSFORMS = [{"name": "digest"}]
 
 
 class S3ObjectLambdaStack(Stack):
@@ -91,12 +96,14 @@ class S3ObjectLambdaStack(Stack):
             object_lambda_configuration=
             s3_object_lambda.CfnAccessPoint.ObjectLambdaConfigurationProperty(
                 supporting_access_point=self.access_point,
+                allowed_features=["GetObject-Range", "GetObject-PartNumber"],
                 transformation_configurations=[
                     s3_object_lambda.CfnAccessPoint.TransformationConfigurationProperty(
                         actions=["GetObject"],
                         content_transformation={
                             "AwsLambda": {
-                                "FunctionArn": f"{retrieve_transformed_object_lambda.function_arn}"
+                                "FunctionArn": f"{retrieve_transformed_object_lambda.function_arn}",
+                                "FunctionPayload": json.dumps({"transforms": TRANSFORMS})
                             }
                         }
                     )
@@ -17,6 +17,8 @@ def _start_mms():
     # by default the number of workers per model is 1, but we can configure it through the
     # environment variable below if desired.
     # os.environ['SAGEMAKER_MODEL_SERVER_WORKERS'] = '2'
+    # requests are batched for models registered with the batch_size and max_batch_delay
+    # parameters of the management API, see "Request batching" in the README.
     model_server.start_model_server(
         handler_service="/home/model-server/model_handler.py:handle"
     )
@@ -2,14 +2,17 @@
 ModelHandler defines an example model handler for load and inference requests for MXNet CPU models
 """
 import glob
+import io
 import json
 import logging
 import os
 import re
+import time
 from collections import namedtuple
 
 import mxnet as mx
 import numpy as np
+from PIL import Image
 
 
 class ModelHandler(object):
@@ -21,6 +24,37 @@ class ModelHandler(object):
         self.initialized = False
         self.mx_model = None
         self.shapes = None
+        self.data_shapes = None
+        self.batch_size = 1
+        # number of classes returned per image, and whether they are returned as
+        # {"class", "probability"} objects ("json") or as formatted strings ("text")
+        self.top_k = int(os.environ.get("TOP_K", "5"))
+        self.output_format = os.environ.get("OUTPUT_FORMAT", "json")
+        # bytes held by the model parameters, logged when the model is loaded
+        self.param_bytes = 0
+        # modules bound for smaller batches, keyed by batch size. They share
+        # the parameters (and memory) of self.mx_model.
+        self.batch_modules = {}
+        # per channel mean and standard deviation subtracted from and divided into the
+        # pixel values, e.g. INPUT_MEAN=123.68,116.78,103.94 and INPUT_STD=58.4,57.12,57.38.
+        # Not needed for models that normalize their input themselves.
+        self.mean, self.inv_std = self.get_normalization()
+        # input buffers reused across requests, see get_input_buffer
+        self.input_buffer = None
+        self.input_arrays = {}
+
+    def get_normalization(self):
+        """
+        Get the per channel mean and inverse standard deviation from INPUT_MEAN and INPUT_STD
+        :return: tuple of arrays of shape (3, 1, 1), or (None, None) without normalization
+        """
+        mean = os.environ.get("INPUT_MEAN")
+        std = os.environ.get("INPUT_STD")
+        if not mean and not std:
+            return None, None
+        mean = np.array([float(m) for m in (mean or "0,0,0").split(",")], dtype=np.float32)
+        std = np.array([float(m) for m in (std or "1,1,1").split(",")], dtype=np.float32)
+        return mean.reshape(-1, 1, 1), (1.0 / std).reshape(-1, 1, 1)
 
     def get_model_files_prefix(self, model_dir):
         """
@@ -72,6 +106,38 @@ class ModelHandler(object):
 
         return data_shapes
 
+    def get_batch_data_shapes(self, batch_size):
+        """
+        Get the model input data shapes with the batch dimension set to batch_size
+
+        :param batch_size: Number of images in a batch
+        :return: list of (name, shape) tuples
+        """
+        return [(name, (batch_size,) + shape[1:]) for name, shape in self.data_shapes]
+
+    def get_module(self, batch_size):
+        """
+        Get a module bound for the given batch size, sharing the parameters of the main module
+
+        :param batch_size: Number of images in a batch
+        :return: MXNet module
+        """
+        if batch_size == self.batch_size:
+            return self.mx_model
+
+        module = self.batch_modules.get(batch_size)
+        if module is None:
+            module = mx.mod.Module(
+                symbol=self.mx_model.symbol, context=self.mx_model._context, label_names=None
+            )
+            module.bind(
+                for_training=False,
+                data_shapes=self.get_batch_data_shapes(batch_size),
+                shared_module=self.mx_model,
+            )
+            self.batch_modules[batch_size] = module
+        return module
+
     def initialize(self, context):
         """
         Initialize model. This will be called during model loading time
@@ -83,17 +149,21 @@ class ModelHandler(object):
         # Contains the url parameter passed to the load request
         model_dir = properties.get("model_dir")
         gpu_id = properties.get("gpu_id")
+        # MMS collects up to batch_size requests (waiting at most max_batch_delay ms)
+        # into one call when the model is registered with these parameters
+        self.batch_size = int(properties.get("batch_size") or 1)
 
         checkpoint_prefix = self.get_model_files_prefix(model_dir)
 
-        # Read the model input data shapes
-        data_shapes = self.get_input_data_shapes(model_dir, checkpoint_prefix)
+        # Read the model input data shapes and bind the model for a full batch
+        self.data_shapes = self.get_input_data_shapes(model_dir, checkpoint_prefix)
+        data_shapes = self.get_batch_data_shapes(self.batch_size)
 
         # Load MXNet model
         try:
             ctx = mx.cpu()  # Set the context on CPU
             sym, arg_params, aux_params = mx.model.load_checkpoint(
-                checkpoint_prefix, 0
+                os.path.join(model_dir, checkpoint_prefix), 0
             )  # epoch set to 0
             self.mx_model = mx.mod.Module(symbol=sym, context=ctx, label_names=None)
             self.mx_model.bind(
@@ -102,63 +172,131 @@ class ModelHandler(object):
                 label_shapes=self.mx_model._label_shapes,
             )
             self.mx_model.set_params(arg_params, aux_params, allow_missing=True)
-            with open("synset.txt", "r") as f:
-                self.labels = [l.rstrip() for l in f]
+            self.param_bytes = sum(
+                p.size * np.dtype(p.dtype).itemsize
+                for p in list(arg_params.values()) + list(aux_params.values())
+            )
+            # Every model has its own labels next to its artifacts
+            with open(os.path.join(model_dir, "synset.txt"), "r") as f:
+                self.labels = np.array([l.rstrip() for l in f])
         except (mx.base.MXNetError, RuntimeError) as memerr:
             if re.search("Failed to allocate (.*) Memory", str(memerr), re.IGNORECASE):
                 logging.error("Memory allocation exception: {}".format(memerr))
                 raise MemoryError
             raise
 
+    def decode_image(self, body, out):
+        """
+        Decode an image straight into a slot of the input buffer, resized and normalized.
+        :param body: encoded image bytes
+        :param out: float32 buffer slot of shape (RGB, height, width)
+        """
+        height, width = out.shape[1:]
+        img = Image.open(io.BytesIO(body))
+        # JPEG images are decoded at the smallest scale (down to 1/8) that is still at least
+        # the input size, which skips most of the decoding work for large photos
+        img.draft("RGB", (width, height))
+        img = img.convert("RGB").resize((width, height), Image.BILINEAR)
+
+        # Channel first and normalize in one pass over the pixels, writing into the buffer
+        pixels = np.asarray(img).transpose((2, 0, 1))
+        if self.mean is None:
+            out[...] = pixels
+        else:
+            np.subtract(pixels, self.mean, out=out)
+            out *= self.inv_std
+
+    def get_input_buffer(self, batch_size):
+        """
+        Get the reusable input buffer for a batch, allocated once for the largest batch seen
+        :param batch_size: Number of images in a batch
+        :return: float32 array of shape (batch, RGB, height, width)
+        """
+        if self.input_buffer is None or self.input_buffer.shape[0] < batch_size:
+            shape = self.get_batch_data_shapes(max(batch_size, self.batch_size))[0][1]
+            self.input_buffer = np.empty(shape, dtype=np.float32)
+            self.input_arrays = {}
+        return self.input_buffer[:batch_size]
+
     def preprocess(self, request):
         """
         Transform raw input into model input data.
         :param request: list of raw requests
-        :return: list of preprocessed model input data
+        :return: tuple of the batch of preprocessed model input data for the images that could
+            be decoded (None if there are none) and a dict of request index => error message
         """
         # Take the input data and pre-process it make it inference ready
+        buffer = self.get_input_buffer(len(request))
+        errors = {}
+        count = 0
 
-        img_list = []
         for idx, data in enumerate(request):
             # Read the bytearray of the image from the input
             img_arr = data.get("body")
+            if not img_arr:
+                errors[idx] = "Missing image"
+                continue
 
-            # Input image is in bytearray, convert it to MXNet NDArray
-            img = mx.img.imdecode(img_arr)
-            if img is None:
-                return None
+            # Decode into the next free slot, so decoded images stay contiguous
+            try:
+                self.decode_image(img_arr, buffer[count])
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                logging.warning("Unable to decode image {}: {}".format(idx, e))
+                errors[idx] = "Unable to decode image"
+                continue
+            count += 1
 
-            # convert into format (batch, RGB, width, height)
-            img = mx.image.imresize(img, 224, 224)  # resize
-            img = img.transpose((2, 0, 1))  # Channel first
-            img = img.expand_dims(axis=0)  # batchify
-            img_list.append(img)
+        if count == 0:
+            return None, errors
 
-        return img_list
+        # Copy the batch into the reusable MXNet input array, (batch, RGB, height, width)
+        model_input = self.input_arrays.get(count)
+        if model_input is None:
+            model_input = mx.nd.empty(buffer[:count].shape)
+            self.input_arrays[count] = model_input
+        model_input[:] = buffer[:count]
+        return [model_input], errors
 
     def inference(self, model_input):
         """
         Internal inference methods
         :param model_input: transformed model input data list
-        :return: list of inference output in NDArray
+        :return: inference output in NDArray, one row per image
         """
         # Do some inference call to engine here and return output
         Batch = namedtuple("Batch", ["data"])
-        self.mx_model.forward(Batch(model_input))
-        prob = self.mx_model.get_outputs()[0].asnumpy()
+        module = self.get_module(model_input[0].shape[0])
+        module.forward(Batch(model_input))
+        prob = module.get_outputs()[0].asnumpy()
         return prob
 
     def postprocess(self, inference_output):
         """
         Return predict result in as list.
-        :param inference_output: list of inference output
-        :return: list of predict results
+        :param inference_output: inference output, one row of class probabilities per image
+        :return: list of predict results, one per request
         """
         # Take output from network and post-process to desired format
-        prob = np.squeeze(inference_output)
-        a = np.argsort(prob)[::-1]
+        prob = inference_output.reshape(inference_output.shape[0], -1)
+        k = min(self.top_k, prob.shape[1])
+
+        # Select the top k classes of every row without sorting all classes,
+        # then sort only those k by probability
+        top = np.argpartition(prob, -k, axis=1)[:, -k:]
+        top_prob = np.take_along_axis(prob, top, axis=1)
+        order = np.argsort(-top_prob, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_prob = np.take_along_axis(top_prob, order, axis=1).tolist()
+        top_labels = self.labels[top].tolist()
+
+        if self.output_format == "text":
+            return [
+                ["probability=%f, class=%s" % (p, l) for p, l in zip(probs, labels)]
+                for probs, labels in zip(top_prob, top_labels)
+            ]
         return [
-            ["probability=%f, class=%s" % (prob[i], self.labels[i]) for i in a[0:5]]
+            [{"class": l, "probability": p} for p, l in zip(probs, labels)]
+            for probs, labels in zip(top_prob, top_labels)
         ]
 
     def handle(self, data, context):
@@ -166,19 +304,46 @@ class ModelHandler(object):
         Call preprocess, inference and post-process functions
         :param data: input data
         :param context: mms context
+        :return: list of predict results, one per request, with an error object for requests
+            whose image could not be processed
         """
 
-        model_input = self.preprocess(data)
-        model_out = self.inference(model_input)
-        return self.postprocess(model_out)
+        model_input, errors = self.preprocess(data)
+        results = []
+        if model_input is not None:
+            model_out = self.inference(model_input)
+            results = self.postprocess(model_out)
+
+        results = iter(results)
+        return [
+            {"error": errors[idx]} if idx in errors else next(results)
+            for idx in range(len(data))
+        ]
+
+
+def add_time(context, name, value):
+    # MMS publishes the metrics added to the context with its own metrics
+    metrics = getattr(context, "metrics", None)
+    if metrics is not None:
+        metrics.add_time(name, value)
 
 
+# MMS starts a worker process per model, so this module, and the one handler in it, belong
+# to a single model. SageMaker loads and unloads the models of a multi-model endpoint itself.
 _service = ModelHandler()
 
 
 def handle(data, context):
     if not _service.initialized:
+        start = time.time()
         _service.initialize(context)
+        load_ms = (time.time() - start) * 1000
+        logging.info(
+            "Loaded model {} ({} parameter bytes) in {:.1f} ms".format(
+                context.system_properties.get("model_dir"), _service.param_bytes, load_ms
+            )
+        )
+        add_time(context, "ModelLoadTime", load_ms)
 
     if data is None:
         return None
@@ -8,7 +8,7 @@ from gengen import GenGen
 
 # our main application stack
 class UrlShortenerStack(WaltersCoStack):
-    def __init__(self, scope: Construct, id: str, **kwarg) -> None:
+    def __init__(self, scope: Construct, id: str, *, dedupe_urls: bool = True, **kwarg) -> None:
         super().__init__(scope, id, **kwarg)
 
         # define the table that maps short codes to URLs.
@@ -31,6 +31,18 @@ class UrlShortenerStack(WaltersCoStack):
         handler.add_environment('TABLE_NAME', table.table_name)
         table.grant_read_write_data(handler)
 
+        # optionally define a reverse index that maps a hash of the normalized
+        # target URL to its short code, so repeated submissions reuse one code.
+        if dedupe_urls:
+            dedupe_table = aws_dynamodb.Table(self, "DedupeTable",
+                                              partition_key=aws_dynamodb.Attribute(
+                                                  name="url_hash",
+                                                  type=aws_dynamodb.AttributeType.STRING),
+                                              read_capacity=10,
+                                              write_capacity=5)
+            handler.add_environment('DEDUPE_TABLE_NAME', dedupe_table.table_name)
+            dedupe_table.grant_read_write_data(handler)
+
         # define the API endpoint and associate the handler
         api = aws_apigateway.LambdaRestApi(self, "UrlShortenerApi",
                                            handler=handler)
@@ -53,11 +65,12 @@ class TrafficGeneratorStack(WaltersCoStack):
     def __init__(self, scope: Construct, id: str):
         super().__init__(scope, id)
 
-        # define a traffic generator instance that hits the URL at 5 TPS
-        # and hosted within the shared waltersco VPC
+        # define a traffic generator instance that sends 100 requests per
+        # second (a mix of creates and redirects) to the URL shortener and is
+        # hosted within the shared waltersco VPC
         GenGen(self, 'generator',
-               url='https://yourdomain.com/eb4628b6',
-               tps=5,
+               url='https://yourdomain.com/',
+               rps=100,
                vpc=self.waltersco_vpc)
 
 
@@ -1,5 +1,8 @@
+import math
+from typing import Optional
+
 from constructs import Construct
-from aws_cdk import aws_ecs, aws_ec2
+from aws_cdk import aws_ecs, aws_ec2, aws_s3
 
 
 # a user-defined construct
@@ -8,34 +11,57 @@ class GenGen(Construct):
     """
     An HTTP traffic generator.
 
-    Hits a specified URL at some TPS.
+    Sends an open-loop mix of create and redirect requests to the URL
+    shortener at a fixed rate and reports latency percentiles and throughput.
     """
 
-    def __init__(self, scope: Construct, id: str, *, vpc: aws_ec2.IVpc, url: str, tps: int):
+    def __init__(self, scope: Construct, id: str, *, vpc: aws_ec2.IVpc, url: str, rps: int,
+                 rps_per_task: int = 50, concurrency: int = 100, create_ratio: float = 0.1,
+                 results_bucket: Optional[aws_s3.IBucket] = None):
         """
         Defines an instance of the traffic generator.
 
-        :param scope: construct scope
-        :param id:    construct id
-        :param vpc:   the VPC in which to host the traffic generator
-        :param url:   the URL to hit
-        :param tps:   the number of transactions per second
+        :param scope:          construct scope
+        :param id:             construct id
+        :param vpc:            the VPC in which to host the traffic generator
+        :param url:            the base URL of the URL shortener
+        :param rps:            the total number of requests per second
+        :param rps_per_task:   the number of requests per second a single task generates
+        :param concurrency:    the maximum number of in-flight requests per task
+        :param create_ratio:   the fraction of requests that create a new short URL
+        :param results_bucket: an optional bucket to upload latency reports to
         """
         super().__init__(scope, id)
 
         # define an ECS cluster hosted within the requested VPC
         cluster = aws_ecs.Cluster(self, 'cluster', vpc=vpc)
 
+        # spread the requested rate evenly across as many tasks as needed
+        task_count = max(1, math.ceil(rps / rps_per_task))
+
+        environment = {
+            'URL': url,
+            'RATE': str(rps / task_count),
+            'CONCURRENCY': str(concurrency),
+            'CREATE_RATIO': str(create_ratio),
+        }
+        if results_bucket is not None:
+            environment['RESULTS_BUCKET'] = results_bucket.bucket_name
+
         # define our task definition with a single container
         # the image is built & published from a local asset directory
-        task_definition = aws_ecs.FargateTaskDefinition(self, 'PingTask')
-        task_definition.add_container('Pinger',
-                                      image=aws_ecs.ContainerImage.from_asset("pinger"),
-                                      environment={'URL': url})
+        task_definition = aws_ecs.FargateTaskDefinition(self, 'LoadGenTask')
+        task_definition.add_container('LoadGen',
+                                      image=aws_ecs.ContainerImage.from_asset("loadgen"),
+                                      environment=environment,
+                                      logging=aws_ecs.LogDrivers.aws_logs(stream_prefix='loadgen'))
+
+        if results_bucket is not None:
+            results_bucket.grant_put(task_definition.task_role)
 
-        # define our fargate service. TPS determines how many instances we
-        # want from our task (each task produces a single TPS)
+        # define our fargate service. each task generates rps / task_count
+        # requests per second
         aws_ecs.FargateService(self, 'service',
                                cluster=cluster,
                                task_definition=task_definition,
-                               desired_count=tps)
+                               desired_count=task_count)
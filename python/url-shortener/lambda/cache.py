@@ -0,0 +1,113 @@
+import json
+import time
+from collections import OrderedDict
+
+# sentinel stored for ids that are known not to exist (negative caching)
+MISSING = object()
+
+
+class LruTtlCache:
+    """
+    A small bounded in-process cache with least-recently-used eviction and
+    per-entry expiry.
+
+    Lives at module scope so warm Lambda invocations can serve hot keys
+    without a round trip to DynamoDB.
+    """
+
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        """
+        :param max_size:     maximum number of entries kept in memory
+        :param ttl:          seconds a found value stays valid
+        :param negative_ttl: seconds a "not found" result stays valid
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        :return: the cached value, MISSING for a cached miss, or None if the
+                 key is not cached (or has expired)
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Caches a value. Pass MISSING to remember that the key does not exist.
+        """
+        if self.max_size <= 0:
+            return
+
+        ttl = self.negative_ttl if value is MISSING else self.ttl
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CacheMetrics:
+    """
+    Periodically emits the cache hit/miss counters as CloudWatch embedded
+    metric format (EMF) log lines so the cache size can be tuned.
+    """
+
+    def __init__(self, cache: LruTtlCache, namespace: str, interval: float):
+        """
+        :param cache:     the cache to report on
+        :param namespace: CloudWatch metrics namespace
+        :param interval:  minimum number of seconds between two reports
+        """
+        self.cache = cache
+        self.namespace = namespace
+        self.interval = interval
+        self._last_flush = time.monotonic()
+        self._last_hits = 0
+        self._last_misses = 0
+
+    def maybe_flush(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.interval:
+            return
+
+        hits = self.cache.hits - self._last_hits
+        misses = self.cache.misses - self._last_misses
+        self._last_flush = now
+        self._last_hits = self.cache.hits
+        self._last_misses = self.cache.misses
+        if hits == 0 and misses == 0:
+            return
+
+        # lambda ships stdout to CloudWatch Logs, which extracts EMF metrics
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [[]],
+                    'Metrics': [
+                        {'Name': 'CacheHits', 'Unit': 'Count'},
+                        {'Name': 'CacheMisses', 'Unit': 'Count'},
+                        {'Name': 'CacheSize', 'Unit': 'Count'},
+                    ]
+                }]
+            },
+            'CacheHits': hits,
+            'CacheMisses': misses,
+            'CacheSize': len(self.cache),
+        }))
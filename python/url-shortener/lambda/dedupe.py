@@ -0,0 +1,35 @@
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str) -> str:
+    """
+    Normalizes a URL so trivially different spellings of the same target map
+    to the same short code: the scheme and host are lowercased, default ports
+    and fragments are dropped and an empty path becomes "/".
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').lower()
+    if ':' in netloc:
+        # hostname drops the brackets of an IPv6 address, which keep its
+        # colons apart from the port
+        netloc = '[' + netloc + ']'
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':%d' % parts.port
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += ':' + parts.password
+        netloc = userinfo + '@' + netloc
+
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+
+def url_hash(url: str) -> str:
+    """
+    :return: the key of a URL in the dedupe table
+    """
+    return hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
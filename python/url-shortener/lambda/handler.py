@@ -1,16 +1,91 @@
+import base64
 import json
 import os
-import uuid
 import logging
+import random
+import time
 
 import boto3
 
+from cache import LruTtlCache, CacheMetrics, MISSING
+from dedupe import normalize_url, url_hash
+from ids import CounterBlockIdGenerator, create_id_generator
+
 LOG = logging.getLogger()
-LOG.setLevel(logging.INFO)
+LOG.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# fraction of requests that get an access log line (1.0 logs every request)
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '1.0'))
+
+# create the DynamoDB table once per container so warm invocations reuse
+# the client and its connection pool
+DYNAMODB = boto3.resource('dynamodb')
+TABLE = DYNAMODB.Table(os.environ.get('TABLE_NAME'))
+
+# optional reverse index of url_hash -> id, used to hand out the existing
+# short code when a target URL is submitted again
+DEDUPE_TABLE_NAME = os.environ.get('DEDUPE_TABLE_NAME')
+DEDUPE_TABLE = DYNAMODB.Table(DEDUPE_TABLE_NAME) if DEDUPE_TABLE_NAME else None
+
+# read-through cache of id -> target_url for the redirect path.
+# misses are cached for a shorter time so new ids created by other
+# containers become visible quickly.
+CACHE = LruTtlCache(max_size=int(os.environ.get('CACHE_SIZE', '10000')),
+                    ttl=float(os.environ.get('CACHE_TTL_SECONDS', '300')),
+                    negative_ttl=float(os.environ.get('CACHE_NEGATIVE_TTL_SECONDS', '5')))
+CACHE_METRICS = CacheMetrics(CACHE,
+                             namespace=os.environ.get('METRICS_NAMESPACE', 'UrlShortener'),
+                             interval=float(os.environ.get('CACHE_METRICS_INTERVAL_SECONDS', '60')))
+
+# the strategy used to mint new short codes ("counter" or "random")
+ID_GENERATOR = create_id_generator(os.environ.get('ID_GENERATOR', 'counter'), TABLE,
+                                   block_size=int(os.environ.get('ID_BLOCK_SIZE', '100')))
+
+# how many times to retry creating a short code that already exists
+MAX_CREATE_ATTEMPTS = 5
+
+# limits for bulk creation. BatchWriteItem accepts at most 25 items per call
+# and BatchGetItem at most 100 keys. every new URL costs a write to each
+# table, so the default keeps a request within what the provisioned write
+# capacity (plus burst) absorbs before API Gateway times out.
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '100'))
+BATCH_WRITE_CHUNK_SIZE = 25
+BATCH_GET_CHUNK_SIZE = 100
+BATCH_WRITE_MAX_ATTEMPTS = 8
+
+
+class LazyJson:
+    """
+    Defers JSON serialization of a log argument until the record is actually
+    formatted, so disabled log levels cost nothing.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, default=str)
 
 
 def main(event, context):
-    LOG.info("EVENT: " + json.dumps(event))
+    start = time.perf_counter()
+    LOG.debug("EVENT: %s", LazyJson(event))
+
+    response = route(event)
+
+    # one compact access log line instead of the whole event, for a sample
+    # of the requests
+    if LOG.isEnabledFor(logging.INFO) and random.random() < LOG_SAMPLE_RATE:
+        LOG.info("ACCESS method=%s path=%s status=%s latency_ms=%.2f",
+                 event.get('httpMethod'), event.get('path'), response.get('statusCode'),
+                 (time.perf_counter() - start) * 1000)
+
+    return response
+
+
+def route(event):
+    if event.get('httpMethod') == 'POST':
+        return create_short_urls(event)
 
     query_string_params = event["queryStringParameters"]
     if query_string_params is not None:
@@ -25,56 +100,311 @@ def main(event, context):
 
     return {
         'statusCode': 200,
-        'body': 'usage: ?targetUrl=URL'
+        'body': 'usage: ?targetUrl=URL or POST a JSON/NDJSON list of target URLs'
     }
 
 
 def create_short_url(event):
-    # Pull out the DynamoDB table name from environment
-    table_name = os.environ.get('TABLE_NAME')
-
     # Parse targetUrl
     target_url = event["queryStringParameters"]['targetUrl']
+    if not is_valid_url(target_url):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'text/plain'},
+            'body': 'invalid target URL: %s' % target_url
+        }
+
+    # Reuse the existing id for this URL or create a new one
+    if DEDUPE_TABLE is not None:
+        id = get_or_create_short_url(target_url)
+    else:
+        id = put_new_short_url(target_url)
 
-    # Create a unique id (take first 8 chars)
-    id = str(uuid.uuid4())[0:8]
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'text/plain'},
+        'body': "Created URL: %s" % short_url(event, id)
+    }
 
-    # Create item in DynamoDB
-    dynamodb = boto3.resource('dynamodb')
-    table = dynamodb.Table(table_name)
-    table.put_item(Item={
-        'id': id,
-        'target_url': target_url
-    })
 
+def short_url(event, id):
     # Create the redirect URL
-    url = "https://" \
+    return "https://" \
         + event["requestContext"]["domainName"] \
         + event["requestContext"]["path"] \
         + id
 
+
+def create_short_urls(event):
+    """
+    Bulk-creates short URLs from a POST body. The body is either a JSON array
+    or newline-delimited JSON (Content-Type: application/x-ndjson); every entry
+    is a target URL string or an object with a "targetUrl" field.
+
+    Created URLs are returned in input order, in the same format as the request.
+    Only available with the counter id generator, see below.
+    """
+    # batch writes cannot be conditional, so this relies on the id generator
+    # handing out unique ids. random ids could silently overwrite a mapping.
+    if not isinstance(ID_GENERATOR, CounterBlockIdGenerator):
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'text/plain'},
+            'body': 'bulk creation requires ID_GENERATOR=counter, use ?targetUrl=URL instead'
+        }
+
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    ndjson = headers.get('content-type', '').startswith('application/x-ndjson')
+
+    try:
+        target_urls = parse_target_urls(event, ndjson)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'text/plain'},
+            'body': str(e)
+        }
+
+    # reuse existing ids (including repeats within this request) when deduping
+    existing_ids = {}
+    if DEDUPE_TABLE is not None:
+        existing_ids = batch_get_existing_ids({url_hash(url) for url in target_urls})
+
+    items = []
+    ids = []
+    for target_url in target_urls:
+        key = url_hash(target_url) if DEDUPE_TABLE is not None else None
+        id = existing_ids.get(key)
+        if id is None:
+            id = ID_GENERATOR.next_id()
+            items.append({'id': id, 'target_url': target_url})
+            if key is not None:
+                existing_ids[key] = id
+        ids.append(id)
+
+    batch_put_items(TABLE, items)
+    if DEDUPE_TABLE is not None:
+        # items that lost a race for their url hash were removed again and
+        # are answered with the id that won
+        winner_ids = register_url_hashes(items)
+        ids = [winner_ids.get(id, id) for id in ids]
+        items = [item for item in items if item['id'] not in winner_ids]
+    for item in items:
+        CACHE.put(item['id'], item['target_url'])
+
+    results = [{'targetUrl': target_url, 'shortUrl': short_url(event, id)}
+               for target_url, id in zip(target_urls, ids)]
+
+    if ndjson:
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/x-ndjson'},
+            'body': ''.join(json.dumps(result) + '\n' for result in results)
+        }
+
     return {
         'statusCode': 200,
-        'headers': {'Content-Type': 'text/plain'},
-        'body': "Created URL: %s" % url
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps(results)
     }
 
 
+def parse_target_urls(event, ndjson):
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode('utf-8')
+
+    try:
+        if ndjson:
+            entries = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            entries = json.loads(body)
+    except ValueError:
+        raise ValueError('request body is not valid JSON')
+
+    if not isinstance(entries, list) or not entries:
+        raise ValueError('expected a non-empty list of target URLs')
+    if len(entries) > BATCH_MAX_ITEMS:
+        raise ValueError('at most %d target URLs can be created per request' % BATCH_MAX_ITEMS)
+
+    target_urls = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            entry = entry.get('targetUrl')
+        if not isinstance(entry, str) or not entry:
+            raise ValueError('every entry must be a URL or an object with a targetUrl')
+        if not is_valid_url(entry):
+            raise ValueError('invalid target URL: %s' % entry)
+        target_urls.append(entry)
+
+    return target_urls
+
+
+def is_valid_url(url):
+    """
+    :return: whether the URL can be parsed (and so normalized for the dedupe
+             table), e.g. False for a non-numeric port or an unclosed "["
+    """
+    try:
+        normalize_url(url)
+    except ValueError:
+        return False
+    return True
+
+
+def register_url_hashes(items):
+    """
+    Records the url hash of newly stored items in the dedupe table. Like
+    get_or_create_short_url, every entry is written with a condition so an
+    entry registered concurrently is never overwritten; an item that lost
+    such a race is removed again.
+
+    If registering fails, the items not registered yet are removed before
+    the error is raised, so retrying the request does not store them twice.
+
+    :return: a dict of the ids of the removed items -> the id registered for their URL
+    """
+    winner_ids = {}
+    for position, item in enumerate(items):
+        key = url_hash(item['target_url'])
+        try:
+            DEDUPE_TABLE.put_item(Item={
+                'url_hash': key,
+                'id': item['id']
+            }, ConditionExpression='attribute_not_exists(url_hash)')
+        except DEDUPE_TABLE.meta.client.exceptions.ConditionalCheckFailedException:
+            winner_ids[item['id']] = DEDUPE_TABLE.get_item(
+                Key={'url_hash': key}, ConsistentRead=True)['Item']['id']
+        except Exception:
+            batch_delete_items(TABLE, [{'id': id} for id in winner_ids]
+                               + [{'id': item['id']} for item in items[position:]])
+            raise
+
+    batch_delete_items(TABLE, [{'id': id} for id in winner_ids])
+    for id in winner_ids:
+        CACHE.put(id, MISSING)
+    return winner_ids
+
+
+def batch_put_items(table, items):
+    """
+    Writes items to a table with batch_write.
+    """
+    batch_write(table, [{'PutRequest': {'Item': item}} for item in items])
+
+
+def batch_delete_items(table, keys):
+    """
+    Deletes items from a table by key with batch_write.
+    """
+    batch_write(table, [{'DeleteRequest': {'Key': key}} for key in keys])
+
+
+def batch_write(table, all_requests):
+    """
+    Sends put or delete requests with BatchWriteItem in chunks of 25,
+    retrying unprocessed requests with exponential backoff and jitter.
+    """
+    for start in range(0, len(all_requests), BATCH_WRITE_CHUNK_SIZE):
+        requests = all_requests[start:start + BATCH_WRITE_CHUNK_SIZE]
+
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            response = DYNAMODB.batch_write_item(RequestItems={table.name: requests})
+            requests = response.get('UnprocessedItems', {}).get(table.name)
+            if not requests:
+                break
+            time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
+        else:
+            raise RuntimeError('%d items were not written after %d attempts'
+                               % (len(requests), BATCH_WRITE_MAX_ATTEMPTS))
+
+
+def batch_get_existing_ids(keys):
+    """
+    Looks up url hashes in the dedupe table with BatchGetItem.
+
+    :return: a dict of url_hash -> id for the hashes that already have an id
+    """
+    keys = list(keys)
+    existing_ids = {}
+    for start in range(0, len(keys), BATCH_GET_CHUNK_SIZE):
+        request = {DEDUPE_TABLE.name: {
+            'Keys': [{'url_hash': key} for key in keys[start:start + BATCH_GET_CHUNK_SIZE]]
+        }}
+
+        for attempt in range(BATCH_WRITE_MAX_ATTEMPTS):
+            response = DYNAMODB.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(DEDUPE_TABLE.name, []):
+                existing_ids[item['url_hash']] = item['id']
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
+        else:
+            raise RuntimeError('dedupe lookup did not complete after %d attempts'
+                               % BATCH_WRITE_MAX_ATTEMPTS)
+
+    return existing_ids
+
+
+def put_new_short_url(target_url):
+    """
+    Stores the target URL under a newly generated id. The write is conditional
+    so an existing mapping is never overwritten; on conflict a new id is tried.
+
+    :return: the new id
+    """
+    for _ in range(MAX_CREATE_ATTEMPTS):
+        id = ID_GENERATOR.next_id()
+        try:
+            TABLE.put_item(Item={
+                'id': id,
+                'target_url': target_url
+            }, ConditionExpression='attribute_not_exists(id)')
+        except TABLE.meta.client.exceptions.ConditionalCheckFailedException:
+            LOG.warning("id %s already exists, retrying", id)
+            continue
+
+        CACHE.put(id, target_url)
+        return id
+
+    raise RuntimeError('unable to allocate a unique id after %d attempts' % MAX_CREATE_ATTEMPTS)
+
+
+def get_or_create_short_url(target_url):
+    """
+    Returns the id already assigned to the (normalized) target URL, or stores
+    the URL under a new id and records it in the dedupe table.
+
+    The dedupe entry is written conditionally after the mapping itself; if
+    another request won the race, its id is returned and ours is removed.
+    """
+    key = url_hash(target_url)
+    item = DEDUPE_TABLE.get_item(Key={'url_hash': key}).get('Item')
+    if item is not None:
+        return item['id']
+
+    id = put_new_short_url(target_url)
+    try:
+        DEDUPE_TABLE.put_item(Item={
+            'url_hash': key,
+            'id': id
+        }, ConditionExpression='attribute_not_exists(url_hash)')
+    except DEDUPE_TABLE.meta.client.exceptions.ConditionalCheckFailedException:
+        TABLE.delete_item(Key={'id': id})
+        CACHE.put(id, MISSING)
+        return DEDUPE_TABLE.get_item(Key={'url_hash': key}, ConsistentRead=True)['Item']['id']
+
+    return id
+
+
 def read_short_url(event):
     # Parse redirect ID from path
     id = event['pathParameters']['proxy']
 
-    # Pull out the DynamoDB table name from the environment
-    table_name = os.environ.get('TABLE_NAME')
-
-    # Load redirect target from DynamoDB
-    ddb = boto3.resource('dynamodb')
-    table = ddb.Table(table_name)
-    response = table.get_item(Key={'id': id})
-    LOG.debug("RESPONSE: " + json.dumps(response))
-
-    item = response.get('Item', None)
-    if item is None:
+    target_url = lookup_target_url(id)
+    CACHE_METRICS.maybe_flush()
+    if target_url is None:
         return {
             'statusCode': 400,
             'headers': {'Content-Type': 'text/plain'},
@@ -85,6 +415,31 @@ def read_short_url(event):
     return {
         'statusCode': 301,
         'headers': {
-            'Location': item.get('target_url')
+            'Location': target_url
         }
-    }
\ No newline at end of file
+    }
+
+
+def lookup_target_url(id):
+    """
+    Resolves a short code, serving from the in-process cache when possible.
+
+    :return: the target URL or None if the id does not exist
+    """
+    target_url = CACHE.get(id)
+    if target_url is not None:
+        return None if target_url is MISSING else target_url
+
+    # Load redirect target from DynamoDB
+    response = TABLE.get_item(Key={'id': id})
+    LOG.debug("RESPONSE: %s", LazyJson(response))
+
+    # items without a target (e.g. the id counter) are not redirects
+    item = response.get('Item', None)
+    if item is None or 'target_url' not in item:
+        CACHE.put(id, MISSING)
+        return None
+
+    target_url = item['target_url']
+    CACHE.put(id, target_url)
+    return target_url
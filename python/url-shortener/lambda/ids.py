@@ -0,0 +1,87 @@
+import secrets
+import threading
+
+BASE62_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# the key of the item that holds the id counter. it contains a character
+# outside the base62 alphabet so it can never clash with a short code.
+COUNTER_KEY = '#counter'
+
+
+def encode_base62(number: int) -> str:
+    """
+    Encodes a non-negative integer using the characters [0-9a-zA-Z].
+    """
+    if number == 0:
+        return BASE62_ALPHABET[0]
+
+    chars = []
+    while number > 0:
+        number, remainder = divmod(number, 62)
+        chars.append(BASE62_ALPHABET[remainder])
+    return ''.join(reversed(chars))
+
+
+class RandomIdGenerator:
+    """
+    Generates random base62 ids of a fixed length.
+    """
+
+    def __init__(self, length: int = 7):
+        """
+        :param length: number of characters per id (7 chars is ~41 bits)
+        """
+        self.length = length
+
+    def next_id(self) -> str:
+        return ''.join(secrets.choice(BASE62_ALPHABET) for _ in range(self.length))
+
+
+class CounterBlockIdGenerator:
+    """
+    Generates short base62 ids from a counter stored in DynamoDB.
+
+    Instead of updating the counter for every id, a block of `block_size`
+    values is leased with a single atomic update and then handed out from
+    memory. Values left in a block when the container is recycled are simply
+    never used.
+    """
+
+    def __init__(self, table, block_size: int = 100):
+        """
+        :param table:      the DynamoDB table holding the counter item
+        :param block_size: number of ids leased per counter update
+        """
+        self.table = table
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self) -> str:
+        with self._lock:
+            if self._next >= self._end:
+                self._lease_block()
+            value = self._next
+            self._next += 1
+        return encode_base62(value)
+
+    def _lease_block(self):
+        response = self.table.update_item(
+            Key={'id': COUNTER_KEY},
+            UpdateExpression='ADD next_value :block',
+            ExpressionAttributeValues={':block': self.block_size},
+            ReturnValues='UPDATED_NEW')
+        self._end = int(response['Attributes']['next_value'])
+        self._next = self._end - self.block_size
+
+
+def create_id_generator(name: str, table, block_size: int = 100):
+    """
+    Creates the id generator selected by name ("counter" or "random").
+    """
+    if name == 'counter':
+        return CounterBlockIdGenerator(table, block_size=block_size)
+    if name == 'random':
+        return RandomIdGenerator()
+    raise ValueError('unknown id generator: %s' % name)
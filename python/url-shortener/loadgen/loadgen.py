@@ -0,0 +1,276 @@
+"""
+An open-loop HTTP load generator for the URL shortener.
+
+Requests are scheduled at a fixed arrival rate, independent of how fast the
+service responds, and latency is measured from the time a request was
+*scheduled* rather than when it was sent. This avoids coordinated omission:
+a slow service cannot slow down the generator and hide its own latency.
+
+The workload is a mix of creates (?targetUrl=...) and redirects of codes
+created earlier. Latency histograms and throughput are reported periodically
+as JSON lines on stdout and, optionally, uploaded to S3. Requests that fail or
+time out are reported in their own latency histogram per operation, so errors
+are neither dropped from the latency nor mixed into that of the responses.
+
+All settings are read from environment variables:
+
+  URL               base URL of the service (e.g. https://go.example.com/)
+  RATE              requests per second to generate (default 10)
+  DURATION          seconds to run, 0 runs forever (default 0)
+  CONCURRENCY       maximum number of in-flight requests (default 100)
+  CREATE_RATIO      fraction of requests that create a URL (default 0.1)
+  REPORT_INTERVAL   seconds between reports (default 10)
+  RESULTS_BUCKET    optional S3 bucket to upload reports to
+  RESULTS_PREFIX    key prefix for uploaded reports (default loadgen/)
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+import uuid
+
+import aiohttp
+
+REPORT_PERCENTILES = (50, 90, 99, 99.9)
+
+# how many created short URLs to remember as redirect targets
+MAX_SHORT_URLS = 10000
+
+
+class LatencyHistogram:
+    """
+    A log-linear latency histogram in the style of HdrHistogram.
+
+    Values (in microseconds) are counted in buckets whose width doubles every
+    2^sub_bucket_bits values, so the relative error of a recorded value is
+    bounded by 2^-sub_bucket_bits regardless of its magnitude.
+    """
+
+    def __init__(self, sub_bucket_bits: int = 7):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros: int):
+        shift = max(0, micros.bit_length() - self.sub_bucket_bits)
+        bucket = (shift, micros >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.max = max(self.max, micros)
+
+    def percentile(self, percentile: float) -> int:
+        """
+        :return: the highest value of the bucket holding the given percentile
+        """
+        if self.total == 0:
+            return 0
+
+        threshold = self.total * percentile / 100.0
+        seen = 0
+        for shift, sub_bucket in sorted(self.counts, key=lambda b: b[1] << b[0]):
+            seen += self.counts[(shift, sub_bucket)]
+            if seen >= threshold:
+                return min(((sub_bucket + 1) << shift) - 1, self.max)
+        return self.max
+
+
+class Stats:
+    """
+    Latency histograms and counters for one reporting interval.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.histograms = {}
+        self.error_histograms = {}
+        self.statuses = {}
+        self.errors = 0
+        # requests that had to wait for a free concurrency slot
+        self.queued = 0
+
+    def record(self, operation: str, status: int, micros: int):
+        self.histograms.setdefault(operation, LatencyHistogram()).record(micros)
+        key = '%s:%d' % (operation, status)
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+
+    def record_error(self, operation: str, micros: int):
+        """
+        Records a request that failed without a response (connection error or
+        timeout), with the time from its schedule until it failed.
+        """
+        self.error_histograms.setdefault(operation, LatencyHistogram()).record(micros)
+        self.errors += 1
+
+    def report(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        operations = {}
+        for operation in set(self.histograms) | set(self.error_histograms):
+            operations[operation] = summarize(self.histograms.get(operation), elapsed)
+            if operation in self.error_histograms:
+                operations[operation]['errors'] = summarize(self.error_histograms[operation], elapsed)
+
+        return {
+            'timestamp': time.time(),
+            'host': socket.gethostname(),
+            'interval_seconds': round(elapsed, 3),
+            'operations': operations,
+            'statuses': self.statuses,
+            'errors': self.errors,
+            'queued': self.queued,
+        }
+
+
+def summarize(histogram, elapsed: float) -> dict:
+    """
+    :return: the count, rate and latency percentiles of a histogram (which may
+             be None if nothing was recorded)
+    """
+    histogram = histogram or LatencyHistogram()
+    latency = {'p%s' % p: histogram.percentile(p) / 1000.0 for p in REPORT_PERCENTILES}
+    latency['max'] = histogram.max / 1000.0
+    return {
+        'count': histogram.total,
+        'rps': round(histogram.total / elapsed, 2),
+        'latency_ms': latency,
+    }
+
+
+class LoadGenerator:
+    def __init__(self, url: str, rate: float, concurrency: int, create_ratio: float):
+        """
+        :param url:          base URL of the URL shortener
+        :param rate:         requests per second
+        :param concurrency:  maximum number of in-flight requests
+        :param create_ratio: fraction of requests that create a new short URL
+        """
+        self.url = url if url.endswith('/') else url + '/'
+        self.rate = rate
+        self.create_ratio = create_ratio
+        self.concurrency = concurrency
+        self.semaphore = None
+        self.short_urls = []
+        self.stats = Stats()
+
+    async def run(self, duration: float, report_interval: float, reporter):
+        # created here so it belongs to the loop started by asyncio.run
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=30)
+        # the default connector allows only 100 connections, which would cap
+        # the concurrency (and hide the wait from the queued counter)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            report_task = asyncio.ensure_future(self._report_loop(report_interval, reporter))
+            try:
+                await self._schedule(session, duration)
+            finally:
+                report_task.cancel()
+                reporter(self._rotate_stats())
+
+    async def _schedule(self, session, duration: float):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        interval = 1.0 / self.rate
+        pending = set()
+        sent = 0
+        while duration <= 0 or sent * interval < duration:
+            # the n-th request is due at start + n * interval, no matter how
+            # long earlier requests took
+            scheduled = start + sent * interval
+            delay = scheduled - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent += 1
+
+            task = asyncio.ensure_future(self._request(session, scheduled))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+
+        if pending:
+            await asyncio.wait(pending)
+
+    async def _request(self, session, scheduled: float):
+        loop = asyncio.get_running_loop()
+        if self.semaphore.locked():
+            self.stats.queued += 1
+
+        # waiting for a free slot counts towards latency since the request
+        # was due at `scheduled`
+        async with self.semaphore:
+            create = not self.short_urls or random.random() < self.create_ratio
+            operation = 'create' if create else 'redirect'
+            try:
+                if create:
+                    target = 'https://example.com/%s' % uuid.uuid4()
+                    async with session.get(self.url, params={'targetUrl': target}) as response:
+                        body = await response.text()
+                        status = response.status
+                    if status == 200 and 'Created URL: ' in body:
+                        self._remember(body.split('Created URL: ', 1)[1].strip())
+                else:
+                    async with session.get(random.choice(self.short_urls), allow_redirects=False) as response:
+                        await response.read()
+                        status = response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # a failed request still took this long, leaving it out would
+                # hide exactly the slowest requests
+                self.stats.record_error(operation, int((loop.time() - scheduled) * 1000000))
+                return
+
+            micros = int((loop.time() - scheduled) * 1000000)
+            self.stats.record(operation, status, micros)
+
+    def _remember(self, short_url: str):
+        if len(self.short_urls) < MAX_SHORT_URLS:
+            self.short_urls.append(short_url)
+        else:
+            self.short_urls[random.randrange(MAX_SHORT_URLS)] = short_url
+
+    async def _report_loop(self, interval: float, reporter):
+        while True:
+            await asyncio.sleep(interval)
+            reporter(self._rotate_stats())
+
+    def _rotate_stats(self) -> dict:
+        stats, self.stats = self.stats, Stats()
+        return stats.report()
+
+
+def create_reporter(bucket: str, prefix: str):
+    """
+    :return: a function that prints a report to stdout and, if a bucket is
+             given, uploads it to S3
+    """
+    s3 = None
+    if bucket:
+        import boto3
+        s3 = boto3.client('s3')
+
+    def report(result: dict):
+        line = json.dumps(result)
+        print(line, flush=True)
+        if s3 is not None:
+            key = '%s%s/%d.json' % (prefix, result['host'], int(result['timestamp'] * 1000))
+            s3.put_object(Bucket=bucket, Key=key, Body=line.encode('utf-8'))
+
+    return report
+
+
+def main():
+    generator = LoadGenerator(url=os.environ['URL'],
+                              rate=float(os.environ.get('RATE', '10')),
+                              concurrency=int(os.environ.get('CONCURRENCY', '100')),
+                              create_ratio=float(os.environ.get('CREATE_RATIO', '0.1')))
+    reporter = create_reporter(os.environ.get('RESULTS_BUCKET'),
+                               os.environ.get('RESULTS_PREFIX', 'loadgen/'))
+
+    asyncio.run(
+        generator.run(duration=float(os.environ.get('DURATION', '0')),
+                      report_interval=float(os.environ.get('REPORT_INTERVAL', '10')),
+                      reporter=reporter))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+A tiny in-memory stand-in for the URL shortener API, used to try out the load
+generator locally:
+
+  $ python stub_server.py 8080 &
+  $ URL=http://localhost:8080/ RATE=200 DURATION=30 python loadgen.py
+
+An optional DELAY_MS environment variable adds a fixed delay to every response.
+"""
+import itertools
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+URLS = {}
+IDS = itertools.count()
+DELAY = float(os.environ.get('DELAY_MS', '0')) / 1000.0
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if DELAY:
+            time.sleep(DELAY)
+
+        url = urlsplit(self.path)
+        target_url = parse_qs(url.query).get('targetUrl')
+        if target_url:
+            id = '%x' % next(IDS)
+            URLS[id] = target_url[0]
+            host = self.headers.get('Host', 'localhost')
+            self._respond(200, 'Created URL: http://%s/%s' % (host, id))
+        elif url.path.strip('/') in URLS:
+            self._respond(301, '', {'Location': URLS[url.path.strip('/')]})
+        else:
+            self._respond(400, 'No redirect found for ' + url.path.strip('/'))
+
+    def _respond(self, status, body, headers=None):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    ThreadingHTTPServer(('', port), StubHandler).serve_forever()
@@ -1,6 +0,0 @@
-#!/bin/sh
-while true; do
-  curl -i $URL
-  sleep 1
-done
-
@@ -0,0 +1,114 @@
+import os
+import sys
+import types
+
+import pytest
+
+LAMBDA_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'lambda')
+
+# the handler creates its boto3 resources at import time, which needs a
+# region and a table name but makes no network calls
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('TABLE_NAME', 'benchmark-table')
+sys.path.insert(0, LAMBDA_DIR)
+
+
+class ConditionalCheckFailedException(Exception):
+    pass
+
+
+class FakeTable:
+    """
+    A dict-backed stand-in for a boto3 DynamoDB Table, supporting the calls
+    and condition expressions used by the handler.
+    """
+
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.items = {}
+        self.meta = types.SimpleNamespace(client=types.SimpleNamespace(
+            exceptions=types.SimpleNamespace(
+                ConditionalCheckFailedException=ConditionalCheckFailedException)))
+
+    def get_item(self, Key, **kwargs):
+        item = self.items.get(Key[self.key])
+        return {'Item': dict(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None):
+        if ConditionExpression is not None and Item[self.key] in self.items:
+            raise ConditionalCheckFailedException()
+        self.items[Item[self.key]] = dict(Item)
+        return {}
+
+    def delete_item(self, Key):
+        self.items.pop(Key[self.key], None)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues):
+        # only "ADD <attribute> :value" is supported
+        attribute = UpdateExpression.split()[1]
+        value = list(ExpressionAttributeValues.values())[0]
+        item = self.items.setdefault(Key[self.key], dict(Key))
+        item[attribute] = item.get(attribute, 0) + value
+        return {'Attributes': {attribute: item[attribute]}}
+
+
+class FakeDynamoDB:
+    """
+    A stand-in for the boto3 DynamoDB service resource's batch operations.
+    """
+
+    def __init__(self, *tables):
+        self.tables = {table.name: table for table in tables}
+
+    def batch_write_item(self, RequestItems):
+        for name, requests in RequestItems.items():
+            for request in requests:
+                if 'DeleteRequest' in request:
+                    self.tables[name].delete_item(Key=request['DeleteRequest']['Key'])
+                else:
+                    self.tables[name].put_item(Item=request['PutRequest']['Item'])
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.tables[name]
+            responses[name] = [table.items[key[table.key]] for key in request['Keys']
+                               if key[table.key] in table.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+@pytest.fixture
+def handler(monkeypatch):
+    """
+    The url-shortener handler module wired to in-memory tables, with an
+    empty redirect cache.
+    """
+    import handler as module
+    from ids import CounterBlockIdGenerator
+
+    table = FakeTable('benchmark-table', 'id')
+    dedupe_table = FakeTable('benchmark-dedupe-table', 'url_hash')
+    monkeypatch.setattr(module, 'TABLE', table)
+    monkeypatch.setattr(module, 'DEDUPE_TABLE', dedupe_table)
+    monkeypatch.setattr(module, 'DYNAMODB', FakeDynamoDB(table, dedupe_table))
+    monkeypatch.setattr(module, 'ID_GENERATOR', CounterBlockIdGenerator(table))
+    module.CACHE._entries.clear()
+    return module
+
+
+def api_event(method='GET', query=None, proxy=None, body=None, headers=None):
+    """
+    :return: a minimal API Gateway proxy integration event
+    """
+    return {
+        'httpMethod': method,
+        'headers': headers or {},
+        'queryStringParameters': query,
+        'pathParameters': {'proxy': proxy} if proxy is not None else None,
+        'requestContext': {'domainName': 'go.example.com', 'path': '/'},
+        'body': body,
+        'isBase64Encoded': False,
+    }
@@ -0,0 +1,122 @@
+"""
+Local benchmarks for the url-shortener request handler.
+
+The handler runs against in-memory tables, so these numbers measure the
+handler's own overhead (parsing, id generation, caching, logging) and catch
+regressions before deploying. Run with:
+
+  $ pip install -r requirements-dev.txt
+  $ pytest tests/benchmark --benchmark-columns=min,median,mean,max,ops
+"""
+import json
+import os
+import subprocess
+import sys
+import tracemalloc
+
+from .conftest import LAMBDA_DIR, api_event
+
+
+def measure_allocations(benchmark, function, *args):
+    """
+    Records the memory allocated by a single call in the benchmark's extra info.
+    """
+    tracemalloc.start()
+    try:
+        function(*args)
+        size, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    benchmark.extra_info['allocated_bytes'] = size
+    benchmark.extra_info['peak_bytes'] = peak
+
+
+def test_create(benchmark, handler):
+    counter = iter(range(10 ** 9))
+
+    def create():
+        event = api_event(query={'targetUrl': 'https://example.com/%d' % next(counter)})
+        return handler.main(event, None)
+
+    measure_allocations(benchmark, create)
+    response = benchmark(create)
+    assert response['statusCode'] == 200
+
+
+def test_create_existing(benchmark, handler):
+    event = api_event(query={'targetUrl': 'https://example.com/popular'})
+    handler.main(event, None)
+
+    measure_allocations(benchmark, handler.main, event, None)
+    response = benchmark(handler.main, event, None)
+    assert response['statusCode'] == 200
+    assert len(handler.TABLE.items) == 2  # the url and the id counter
+
+
+def test_bulk_create(benchmark, handler):
+    counter = iter(range(10 ** 9))
+
+    def bulk_event():
+        # fresh URLs every round, so every round creates 100 new items
+        start = next(counter) * 100
+        body = json.dumps(['https://example.com/bulk/%d' % i for i in range(start, start + 100)])
+        event = api_event(method='POST', body=body, headers={'Content-Type': 'application/json'})
+        return (event, None), {}
+
+    measure_allocations(benchmark, handler.main, *bulk_event()[0])
+    response = benchmark.pedantic(handler.main, setup=bulk_event, rounds=100)
+    assert response['statusCode'] == 200
+    assert len(json.loads(response['body'])) == 100
+    assert len(handler.TABLE.items) == 101 * 100 + 1  # every url and the id counter
+
+
+def test_redirect_cached(benchmark, handler):
+    created = handler.main(api_event(query={'targetUrl': 'https://example.com/'}), None)
+    id = created['body'].rsplit('/', 1)[1]
+    event = api_event(proxy=id)
+
+    measure_allocations(benchmark, handler.main, event, None)
+    response = benchmark(handler.main, event, None)
+    assert response['statusCode'] == 301
+
+
+def test_redirect_uncached(benchmark, handler):
+    created = handler.main(api_event(query={'targetUrl': 'https://example.com/'}), None)
+    id = created['body'].rsplit('/', 1)[1]
+    event = api_event(proxy=id)
+
+    def redirect():
+        handler.CACHE._entries.clear()
+        return handler.main(event, None)
+
+    measure_allocations(benchmark, redirect)
+    response = benchmark(redirect)
+    assert response['statusCode'] == 301
+
+
+def test_redirect_missing(benchmark, handler):
+    event = api_event(proxy='missing')
+
+    measure_allocations(benchmark, handler.main, event, None)
+    response = benchmark(handler.main, event, None)
+    assert response['statusCode'] == 400
+
+
+def test_cold_start_import(benchmark):
+    """
+    Measures importing the handler in a fresh interpreter, which is what a
+    Lambda cold start pays on top of the runtime's own startup.
+    """
+    script = ('import time; start = time.perf_counter(); import handler; '
+              'print(time.perf_counter() - start)')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [LAMBDA_DIR, os.environ.get('PYTHONPATH')])))
+
+    def cold_import():
+        output = subprocess.run([sys.executable, '-c', script], env=env, check=True,
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout
+        return float(output.strip().splitlines()[-1])
+
+    import_seconds = benchmark.pedantic(cold_import, rounds=5, iterations=1)
+    benchmark.extra_info['import_seconds'] = import_seconds